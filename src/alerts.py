@@ -0,0 +1,466 @@
+import os
+import math
+import time
+import bisect
+import asyncio
+import logging
+import sqlite3
+import threading
+
+from decouple import config
+
+logger = logging.getLogger(__name__)
+
+ALERTS_PATH = config("ALERTS_PATH", default="data/alerts.sqlite")
+ALERT_MAX_PER_CHAT = config("ALERT_MAX_PER_CHAT", default=50, cast=int)
+# default move in percent that triggers a /watch notification
+WATCH_PERCENT = config("WATCH_PERCENT", default=5.0, cast=float)
+
+# Telegram allows about 30 messages per second overall and one per second per chat
+NOTIFY_RATE = config("NOTIFY_RATE", default=25.0, cast=float)
+NOTIFY_CHAT_INTERVAL = config("NOTIFY_CHAT_INTERVAL", default=1.0, cast=float)
+MESSAGE_LIMIT = 4096
+
+METRICS = ('price', 'volume')
+
+
+class Alert:
+    """
+    A one-shot threshold ('alert'), or a repeating move of percent from a
+    reference price that is reset every time it fires ('watch'). For a watch
+    threshold holds the reference and direction is None.
+    """
+
+    __slots__ = ('id', 'chat_id', 'pair_id', 'pair_address', 'label', 'metric',
+                 'kind', 'direction', 'threshold', 'percent', 'created_at')
+
+    def __init__(self, id, chat_id, pair_id, pair_address, label, metric,
+                 kind, direction, threshold, percent, created_at):
+        self.id = id
+        self.chat_id = chat_id
+        self.pair_id = pair_id
+        self.pair_address = pair_address
+        self.label = label
+        self.metric = metric
+        self.kind = kind
+        self.direction = direction
+        self.threshold = threshold
+        self.percent = percent
+        self.created_at = created_at
+
+    def row(self) -> tuple:
+        return tuple(getattr(self, field) for field in Alert.__slots__)
+
+    def levels(self) -> list:
+        """
+        @return: list : (side, level) pairs, side is 'above' or 'below'
+        """
+        if self.kind == 'watch':
+            move = self.percent / 100
+            return [('above', self.threshold * (1 + move)), ('below', self.threshold * (1 - move))]
+        return [(self.direction, self.threshold)]
+
+    def describe(self) -> str:
+        if self.kind == 'watch':
+            return f"#{self.id} {self.label} price moves {self.percent:g}% from {format_value('price', self.threshold)}"
+        return f"#{self.id} {self.label} {self.metric} {self.direction} {format_value(self.metric, self.threshold)}"
+
+
+def format_value(metric: str, value: float) -> str:
+    if metric == 'volume':
+        return f"${value:,.0f}"
+    return f"${value:.4g}"
+
+
+class _Levels:
+    """
+    Sorted (level, alert id) lists of one (pair_id, metric).
+    """
+
+    __slots__ = ('above', 'below')
+
+    def __init__(self):
+        self.above = []
+        self.below = []
+
+
+class AlertEngine:
+    """
+    Price and 24h volume alerts, indexed so an update only touches the alerts it fires.
+
+    Every (pair_id, metric) keeps two sorted lists of (level, alert id):
+    levels waiting to be risen above and levels waiting to be fallen below.
+    An update bisects both lists and cuts off the crossed slices, so its cost
+    depends on the alerts that fire, not on the alerts that exist. Alerts are
+    stored in SQLite and indexed again on load.
+    """
+
+    FIELDS = Alert.__slots__
+
+    def __init__(self, path=ALERTS_PATH, max_per_chat=ALERT_MAX_PER_CHAT):
+        """
+        @param path: str : the sqlite database file, ':memory:' to not persist the alerts
+        @param max_per_chat: int : most alerts a chat may have
+        """
+        self.path = path
+        self.max_per_chat = max_per_chat
+
+        self.alerts = {}
+        self.by_chat = {}
+        self.by_pair = {}
+        self.levels = {}
+
+        self._db = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.alerts)
+
+    def load(self):
+        """
+        Read the stored alerts into the indexes.
+        """
+        with self._lock:
+            rows = self._connect().execute(f"SELECT {', '.join(AlertEngine.FIELDS)} FROM alerts").fetchall()
+            for row in rows:
+                alert = Alert(*row)
+                self._index(alert, levels=False)
+                levels = self.levels.setdefault((alert.pair_id, alert.metric), _Levels())
+                for side, level in alert.levels():
+                    getattr(levels, side).append((level, alert.id))
+
+            # one sort per list instead of an insort per alert
+            for levels in self.levels.values():
+                levels.above.sort()
+                levels.below.sort()
+
+        logger.info(f"Loaded {len(rows)} alerts on {len(self.by_pair)} pairs")
+        return self
+
+    def add_alert(self, chat_id, pair_id, pair_address, label, metric, threshold, current=None) -> Alert:
+        """
+        Notify once when metric crosses threshold.
+        @param metric: str : 'price' or 'volume' (24h)
+        @param threshold: float : the level to cross, in USD
+        @param current: float : the current value, decides whether the level is crossed upwards or downwards
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric}, use one of: {', '.join(METRICS)}")
+        if not threshold > 0:
+            raise ValueError("The threshold must be positive")
+
+        direction = 'above' if current is None or threshold > current else 'below'
+        return self._add(chat_id, pair_id, pair_address, label, metric, 'alert', direction, threshold, None)
+
+    def add_watch(self, chat_id, pair_id, pair_address, label, reference, percent=WATCH_PERCENT) -> Alert:
+        """
+        Notify every time the price moves by percent, starting from reference.
+        @param reference: float : the current price
+        @param percent: float : the move, in percent
+        """
+        if not reference > 0:
+            raise ValueError("The pair has no price yet")
+        if not 0 < percent < 100:
+            raise ValueError("The move must be between 0 and 100%")
+
+        return self._add(chat_id, pair_id, pair_address, label, 'price', 'watch', None, reference, percent)
+
+    def remove(self, alert_id, chat_id=None) -> bool:
+        """
+        @param chat_id: int : only remove the alert if it belongs to this chat
+        @return: bool : whether the alert existed
+        """
+        with self._lock:
+            alert = self.alerts.get(alert_id)
+            if alert is None or (chat_id is not None and alert.chat_id != chat_id):
+                return False
+
+            self._unindex(alert)
+            self._delete([alert.id])
+            return True
+
+    def remove_chat(self, chat_id) -> int:
+        """
+        Remove every alert of a chat, e.g. after the bot was blocked.
+        @return: int : the number of alerts removed
+        """
+        with self._lock:
+            alerts = [self.alerts[alert_id] for alert_id in self.by_chat.get(chat_id, ())]
+            for alert in alerts:
+                self._unindex(alert)
+            self._delete([alert.id for alert in alerts])
+            return len(alerts)
+
+    def list(self, chat_id) -> list:
+        with self._lock:
+            return sorted((self.alerts[alert_id] for alert_id in self.by_chat.get(chat_id, ())),
+                          key=lambda alert: alert.id)
+
+    def has_pair(self, pair_id) -> bool:
+        return int(pair_id) in self.by_pair
+
+    def pairs(self, metric=None) -> dict:
+        """
+        @param metric: str : only pairs with alerts on this metric
+        @return: dict : pair_id -> pair_address
+        """
+        with self._lock:
+            return {pair_id: self.alerts[next(iter(alert_ids))].pair_address
+                    for pair_id, alert_ids in self.by_pair.items()
+                    if metric is None or (pair_id, metric) in self.levels}
+
+    def update(self, pair_id, metric: str, value: float) -> list:
+        """
+        Evaluate a new value of a pair. One-shot alerts that fire are removed,
+        watches are moved to the new value.
+        @return: list : (chat_id, message) of the alerts that fired
+        """
+        if value is None or math.isnan(value):
+            return []
+
+        key = (int(pair_id), metric)
+        with self._lock:
+            levels = self.levels.get(key)
+            if levels is None:
+                return []
+
+            end = bisect.bisect_right(levels.above, (value, math.inf))
+            start = bisect.bisect_left(levels.below, (value, -1))
+            if end == 0 and start == len(levels.below):
+                return []
+
+            crossed = [alert_id for _, alert_id in levels.above[:end]]
+            crossed += [alert_id for _, alert_id in levels.below[start:]]
+            del levels.above[:end]
+            del levels.below[start:]
+
+            messages, done, moved = [], [], []
+            for alert_id in dict.fromkeys(crossed):
+                alert = self.alerts[alert_id]
+                messages.append((alert.chat_id, self._message(alert, value)))
+
+                if alert.kind == 'watch':
+                    self._unindex_levels(alert)
+                    alert.threshold = value
+                    self._index_levels(alert)
+                    moved.append(alert)
+                else:
+                    self._unindex(alert)
+                    done.append(alert.id)
+
+            self._delete(done, commit=False)
+            self._write(moved)
+
+        return messages
+
+    def _add(self, chat_id, pair_id, pair_address, label, metric, kind, direction, threshold, percent) -> Alert:
+        with self._lock:
+            if len(self.by_chat.get(chat_id, ())) >= self.max_per_chat:
+                raise ValueError(f"A chat can have at most {self.max_per_chat} alerts, remove one with /unalert")
+
+            alert = Alert(None, chat_id, int(pair_id), pair_address, label, metric,
+                          kind, direction, float(threshold), percent, time.time())
+            db = self._connect()
+            cursor = db.execute(
+                f"INSERT INTO alerts ({', '.join(AlertEngine.FIELDS[1:])}) "
+                f"VALUES ({', '.join('?' * (len(AlertEngine.FIELDS) - 1))})",
+                alert.row()[1:]
+            )
+            db.commit()
+            alert.id = cursor.lastrowid
+
+            self._index(alert)
+            return alert
+
+    @staticmethod
+    def _message(alert: Alert, value: float) -> str:
+        if alert.kind == 'watch':
+            change = (value - alert.threshold) / alert.threshold * 100
+            return (f"🔔 {alert.label} price {change:+.1f}%: "
+                    f"{format_value('price', alert.threshold)} → {format_value('price', value)} (#{alert.id})")
+        return (f"🔔 {alert.label} {alert.metric} is {alert.direction} {format_value(alert.metric, alert.threshold)}: "
+                f"{format_value(alert.metric, value)} (#{alert.id}, removed)")
+
+    def _index(self, alert: Alert, levels=True):
+        self.alerts[alert.id] = alert
+        self.by_chat.setdefault(alert.chat_id, set()).add(alert.id)
+        self.by_pair.setdefault(alert.pair_id, set()).add(alert.id)
+        if levels:
+            self._index_levels(alert)
+
+    def _unindex(self, alert: Alert):
+        self._unindex_levels(alert)
+        del self.alerts[alert.id]
+        for index, key in ((self.by_chat, alert.chat_id), (self.by_pair, alert.pair_id)):
+            ids = index[key]
+            ids.discard(alert.id)
+            if not ids:
+                del index[key]
+
+    def _index_levels(self, alert: Alert):
+        levels = self.levels.setdefault((alert.pair_id, alert.metric), _Levels())
+        for side, level in alert.levels():
+            bisect.insort(getattr(levels, side), (level, alert.id))
+
+    def _unindex_levels(self, alert: Alert):
+        key = (alert.pair_id, alert.metric)
+        levels = self.levels.get(key)
+        if levels is None:
+            return
+
+        for side, level in alert.levels():
+            entries = getattr(levels, side)
+            i = bisect.bisect_left(entries, (level, alert.id))
+            # already gone if this is the side that was just crossed
+            if i < len(entries) and entries[i] == (level, alert.id):
+                del entries[i]
+
+        if not levels.above and not levels.below:
+            del self.levels[key]
+
+    def _delete(self, alert_ids, commit=True):
+        if alert_ids:
+            self._connect().executemany("DELETE FROM alerts WHERE id = ?", [(alert_id,) for alert_id in alert_ids])
+        if commit:
+            self._connect().commit()
+
+    def _write(self, alerts):
+        db = self._connect()
+        if alerts:
+            db.executemany("UPDATE alerts SET threshold = ? WHERE id = ?",
+                           [(alert.threshold, alert.id) for alert in alerts])
+        db.commit()
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS alerts ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, pair_id INTEGER, "
+                "pair_address TEXT, label TEXT, metric TEXT, kind TEXT, direction TEXT, "
+                "threshold REAL, percent REAL, created_at REAL)"
+            )
+        return self._db
+
+
+class Notifier:
+    """
+    Sends notifications within Telegram's rate limits.
+
+    Messages are queued per chat, and the ones that pile up while a chat
+    waits for its turn go out joined into one message. Each chat gets at
+    most one message every chat_interval seconds, all chats together at
+    most rate messages a second. A flood wait from Telegram pauses sending.
+    """
+
+    def __init__(self, send, rate=NOTIFY_RATE, chat_interval=NOTIFY_CHAT_INTERVAL):
+        """
+        @param send: async callable : send(chat_id, text) delivers one message
+        @param rate: float : messages per second over all chats
+        @param chat_interval: float : seconds between two messages to the same chat
+        """
+        self.send = send
+        self.rate = rate
+        self.chat_interval = chat_interval
+
+        # chat_id -> texts, chats in the order they became pending
+        self.pending = {}
+        self.sent_at = {}
+        self.sent = 0
+
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    def push(self, chat_id, text: str):
+        """
+        Queue a message, safe to call from any thread.
+        """
+        with self._lock:
+            self.pending.setdefault(chat_id, []).append(text)
+
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def start(self) -> asyncio.Task:
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            if self.pending:
+                self._wakeup.set()
+            self._task = asyncio.create_task(self.run(), name="notifier")
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            while True:
+                chat_id, text, wait = self._next()
+                if text is None:
+                    if wait is None:
+                        break
+                    await asyncio.sleep(wait)
+                    continue
+
+                await self._send(chat_id, text)
+                await asyncio.sleep(1 / self.rate)
+
+    def _next(self) -> tuple:
+        """
+        @return: tuple : (chat_id, text, None) of the next message, or
+                         (None, None, seconds until a chat may be sent to), wait is None if nothing is pending
+        """
+        now = time.monotonic()
+        wait = None
+
+        with self._lock:
+            for chat_id, texts in self.pending.items():
+                ready_at = self.sent_at.get(chat_id, 0.0) + self.chat_interval
+                if ready_at > now:
+                    wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                    continue
+
+                del self.pending[chat_id]
+                size, count = 0, 0
+                for text in texts:
+                    size += len(text) + 2
+                    if count and size > MESSAGE_LIMIT:
+                        break
+                    count += 1
+                if count < len(texts):
+                    # the rest waits for the chat's next turn
+                    self.pending[chat_id] = texts[count:]
+
+                return chat_id, '\n\n'.join(texts[:count])[:MESSAGE_LIMIT], None
+
+        return None, None, wait
+
+    async def _send(self, chat_id, text: str):
+        try:
+            await self.send(chat_id, text)
+            self.sent += 1
+        except Exception as e:
+            retry_after = getattr(e, 'retry_after', None)
+            if not retry_after:
+                logger.error(f"Notifying {chat_id} failed: {e}")
+            else:
+                logger.warning(f"Flood wait of {retry_after}s while notifying {chat_id}")
+                with self._lock:
+                    self.pending[chat_id] = [text] + self.pending.pop(chat_id, [])
+                await asyncio.sleep(retry_after)
+
+        now = time.monotonic()
+        self.sent_at[chat_id] = now
+        if len(self.sent_at) > 10000:
+            self.sent_at = {chat: at for chat, at in self.sent_at.items() if now - at < self.chat_interval}
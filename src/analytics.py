@@ -0,0 +1,359 @@
+import time
+import threading
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+# hours for 1h, 12h, 24h and 1 week (168h) trends
+TREND_WINDOWS = (1, 12, 24, 168)
+
+# 24h sums: stat name -> candle column
+SUM_COLUMNS = {
+    'volume': 'v',
+    'buy_volume': 'bv',
+    'sell_volume': 'sv',
+    'transactions': 'tc',
+    'buy_transactions': 'b',
+    'sell_transactions': 's',
+}
+
+# pairs are told apart in the concatenated ts by adding pair_index << TS_BITS
+TS_BITS = 40
+
+
+def compute(df, windows=TREND_WINDOWS, now=None) -> dict:
+    """
+    Compute the trend and 24h statistics of one pair.
+    @param df: pd.DataFrame : the candles, sorted by ts
+    @param windows: tuple : the trend windows in hours
+    @param now: int : unix time the windows end at, defaults to the current time
+    @return: dict : see compute_many
+    """
+    return compute_many({0: df}, windows, now).get(0)
+
+
+def compute_many(frames: dict, windows=TREND_WINDOWS, now=None) -> dict:
+    """
+    Compute the trend and 24h statistics of many pairs in a single pass.
+
+    The candles of all pairs are concatenated, window starts are found with
+    searchsorted on the sorted ts, sums come from cumulative sums and
+    highs/lows from reduceat, so no per-window frames are built.
+
+    @param frames: dict : key -> candles dataframe sorted by ts
+    @param windows: tuple : the trend windows in hours
+    @param now: int or dict : unix time the windows end at, per key if a dict,
+                              defaults to the current time
+    @return: dict : key -> {
+        'trends': {'<h>h_trend': % change, ...},
+        'volume', 'buy_volume', 'sell_volume',
+        'transactions', 'buy_transactions', 'sell_transactions',
+        'peak_price', 'low_price' (24h),
+        'current_price', 'peak_price_all', 'peak_price_time'
+    }, pairs without candles are left out
+    """
+    keys = [key for key, df in frames.items() if len(df)]
+    if not keys:
+        return {}
+
+    lengths = np.array([len(frames[key]) for key in keys])
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+
+    def column(name, dtype=np.float64):
+        return np.concatenate([frames[key][name].to_numpy(dtype) for key in keys])
+
+    ts = column('ts', np.int64)
+    o, c, h, l = column('o'), column('c'), column('h'), column('l')
+
+    if now is None:
+        now = time.time()
+    if isinstance(now, dict):
+        anchors = np.array([now[key] for key in keys], dtype=np.int64)
+    else:
+        anchors = np.full(len(keys), int(now), dtype=np.int64)
+
+    # index of the first candle of every (pair, window)
+    offsets = np.arange(len(keys), dtype=np.int64) << TS_BITS
+    hours = np.array(sorted(set(windows) | {24}), dtype=np.int64)
+    cutoffs = offsets[:, None] + (anchors[:, None] - hours[None, :] * 3600)
+    first = np.searchsorted(ts + np.repeat(offsets, lengths), cutoffs, side='right')
+    has_data = first < ends[:, None]
+
+    # trends from the open of the first candle to the last close
+    initial = o[np.minimum(first, len(o) - 1)]
+    final = c[ends - 1][:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        trends = np.where(has_data, (final - initial) / initial * 100, np.nan)
+
+    # 24h sums as differences of cumulative sums
+    day = np.searchsorted(hours, 24)
+    first_24h = first[:, day]
+    sums = np.column_stack([column(name) for name in SUM_COLUMNS.values()])
+    cumulative = np.vstack([np.zeros(len(SUM_COLUMNS)), np.cumsum(sums, axis=0)])
+    sums_24h = cumulative[ends] - cumulative[first_24h]
+
+    # 24h high/low over [first_24h, end), reduceat needs an in-bounds end index
+    bounds = np.column_stack([first_24h, ends]).ravel()
+    peak_24h = np.maximum.reduceat(np.append(h, np.nan), bounds)[::2]
+    low_24h = np.minimum.reduceat(np.append(l, np.nan), bounds)[::2]
+    peak_24h = np.where(has_data[:, day], peak_24h, np.nan)
+    low_24h = np.where(has_data[:, day], low_24h, np.nan)
+
+    # all time high and the first candle that reached it
+    peak_all = np.maximum.reduceat(h, starts)
+    at_peak = np.flatnonzero(h == np.repeat(peak_all, lengths))
+    peak_idx = at_peak[np.searchsorted(at_peak, starts)]
+
+    window_idx = {hour: int(np.searchsorted(hours, hour)) for hour in windows}
+
+    results = {}
+    for g, key in enumerate(keys):
+        stats = {
+            'trends': {f'{hour}h_trend': float(trends[g, i])
+                       for hour, i in window_idx.items() if has_data[g, i]},
+        }
+        for i, name in enumerate(SUM_COLUMNS):
+            stats[name] = float(sums_24h[g, i])
+
+        stats['peak_price'] = float(peak_24h[g])
+        stats['low_price'] = float(low_24h[g])
+        stats['current_price'] = float(h[ends[g] - 1])
+        stats['peak_price_all'] = float(peak_all[g])
+        stats['peak_price_time'] = pd.to_datetime(ts[peak_idx[g]], unit='s')
+
+        results[key] = stats
+
+    return results
+
+
+class _Window:
+    """
+    Running sums and monotonic min/max deques of one trailing window.
+    """
+
+    def __init__(self, seconds: int):
+        self.seconds = seconds
+        self.start = 0
+        self.sums = [0.0] * len(SUM_COLUMNS)
+        self.highs = deque()
+        self.lows = deque()
+
+    def push(self, index: int, bar: dict):
+        for i, column in enumerate(SUM_COLUMNS.values()):
+            self.sums[i] += bar[column]
+
+        while self.highs and self.highs[-1][1] <= bar['h']:
+            self.highs.pop()
+        self.highs.append((index, bar['h']))
+
+        while self.lows and self.lows[-1][1] >= bar['l']:
+            self.lows.pop()
+        self.lows.append((index, bar['l']))
+
+    def peek(self, bars, first_index: int, cutoff: int) -> tuple:
+        """
+        What the window holds once expired up to cutoff, without expiring it.
+        @return: tuple : the start index, the sums and the high and low (None if empty)
+        """
+        start, sums = self.start, list(self.sums)
+        while start - first_index < len(bars) and bars[start - first_index]['ts'] <= cutoff:
+            bar = bars[start - first_index]
+            for i, column in enumerate(SUM_COLUMNS.values()):
+                sums[i] -= bar[column]
+            start += 1
+
+        # the deques are ordered by index, only their expired front is skipped
+        high = next((value for index, value in self.highs if index >= start), None)
+        low = next((value for index, value in self.lows if index >= start), None)
+        return start, sums, high, low
+
+    def expire(self, bars, first_index: int, cutoff: int):
+        """
+        Drop the bars with ts <= cutoff from the front of the window.
+        """
+        while self.start - first_index < len(bars) and bars[self.start - first_index]['ts'] <= cutoff:
+            bar = bars[self.start - first_index]
+            for i, column in enumerate(SUM_COLUMNS.values()):
+                self.sums[i] -= bar[column]
+            self.start += 1
+
+        while self.highs and self.highs[0][0] < self.start:
+            self.highs.popleft()
+        while self.lows and self.lows[0][0] < self.start:
+            self.lows.popleft()
+
+
+class RollingMetrics:
+    """
+    Trend and 24h statistics of one pair, maintained incrementally.
+
+    Completed bars live in a ring buffer, every window keeps running sums
+    and monotonic deques for its high and low, so appending a bar updates
+    all windows in amortized O(1). The newest bar may still be in progress,
+    it is kept aside and replaced by updates with the same ts until a newer
+    bar arrives. Windows end at the newest bar, like compute(df, now=last ts).
+    """
+
+    COLUMNS = ('ts', 'o', 'h', 'l', 'c', *SUM_COLUMNS.values())
+
+    def __init__(self, windows=TREND_WINDOWS):
+        """
+        @param windows: tuple : the trend windows in hours
+        """
+        self.hours = tuple(windows)
+        self.windows = {hour: _Window(hour * 3600) for hour in sorted(set(windows) | {24})}
+
+        self.bars = deque()
+        self.first_index = 0
+        self.pending = None
+
+        self.peak_price_all = float('-inf')
+        self.peak_price_ts = None
+
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_frame(cls, df, windows=TREND_WINDOWS) -> 'RollingMetrics':
+        metrics = cls(windows)
+        metrics.update_frame(df)
+        return metrics
+
+    def update_frame(self, df):
+        """
+        Feed every candle of a dataframe sorted by ts.
+        """
+        columns = [df[column].to_numpy() for column in RollingMetrics.COLUMNS]
+        for values in zip(*columns):
+            self.update(dict(zip(RollingMetrics.COLUMNS, values)))
+
+    def update(self, candle: dict):
+        """
+        Add a candle, or replace the in-progress one if it has the same ts.
+        Candles older than the newest one are ignored.
+        @param candle: dict : with at least the ts, o, h, l, c, v, bv, sv, tc, b and s fields
+        """
+        bar = {column: (int(candle[column]) if column == 'ts' else float(candle[column]))
+               for column in RollingMetrics.COLUMNS}
+
+        with self._lock:
+            if self.pending is not None:
+                if bar['ts'] < self.pending['ts']:
+                    return
+                if bar['ts'] > self.pending['ts']:
+                    self._commit(self.pending)
+
+            self.pending = bar
+
+            cutoff_ts = bar['ts']
+            for window in self.windows.values():
+                window.expire(self.bars, self.first_index, cutoff_ts - window.seconds)
+
+            # the largest window decides which bars are still needed
+            oldest = min(window.start for window in self.windows.values())
+            while self.bars and self.first_index < oldest:
+                self.bars.popleft()
+                self.first_index += 1
+
+    def snapshot(self, live=None) -> dict:
+        """
+        @param live: dict : an in-progress bar with ts, o, h, l and c, merged on top
+                            of the candles like bc_tools.live.merge_bar if it is not older
+        @return: dict : the same fields as compute(), None without candles
+        """
+        with self._lock:
+            pending = self.pending
+            if pending is None:
+                return None
+
+            if live is not None and live['ts'] < pending['ts']:
+                live = None
+            if live is None:
+                tail = [pending]
+            elif live['ts'] == pending['ts']:
+                # the volumes of the newest bar stay, a live bar has none
+                tail = [dict(pending,
+                             h=max(pending['h'], live['h']),
+                             l=min(pending['l'], live['l']),
+                             c=live['c'])]
+            else:
+                # a newer bar follows the newest one, without volumes
+                bar = dict(pending, ts=int(live['ts']), **{column: 0.0 for column in SUM_COLUMNS.values()})
+                bar.update({column: float(live[column]) for column in ('o', 'h', 'l', 'c')})
+                tail = [pending, bar]
+            last = tail[-1]
+
+            # the windows end at the newest bar, a newer live bar pushes them further
+            # than update did, read them as expired without expiring them
+            views = {hour: window.peek(self.bars, self.first_index, last['ts'] - window.seconds)
+                     for hour, window in self.windows.items()}
+
+            stats = {'trends': {}}
+            for hour in self.hours:
+                start, cutoff = views[hour][0], last['ts'] - self.windows[hour].seconds
+                offset = start - self.first_index
+                first = self.bars[offset] if offset < len(self.bars) else next(bar for bar in tail if bar['ts'] > cutoff)
+                stats['trends'][f'{hour}h_trend'] = (last['c'] - first['o']) / first['o'] * 100
+
+            _, sums, high, low = views[24]
+            day_tail = [bar for bar in tail if bar['ts'] > last['ts'] - self.windows[24].seconds]
+            for i, (name, column) in enumerate(SUM_COLUMNS.items()):
+                stats[name] = sums[i] + sum(bar[column] for bar in day_tail)
+
+            stats['peak_price'] = max(bar['h'] for bar in day_tail)
+            stats['low_price'] = min(bar['l'] for bar in day_tail)
+            if high is not None:
+                stats['peak_price'] = max(stats['peak_price'], high)
+                stats['low_price'] = min(stats['low_price'], low)
+            stats['current_price'] = last['h'] if live is None else last['c']
+
+            stats['peak_price_all'] = self.peak_price_all
+            stats['peak_price_time'] = self.peak_price_ts
+            for bar in tail:
+                if bar['h'] > stats['peak_price_all']:
+                    stats['peak_price_all'], stats['peak_price_time'] = bar['h'], bar['ts']
+            stats['peak_price_time'] = pd.Timestamp(stats['peak_price_time'], unit='s')
+
+            return stats
+
+    def _commit(self, bar):
+        index = self.first_index + len(self.bars)
+        self.bars.append(bar)
+
+        for window in self.windows.values():
+            window.push(index, bar)
+
+        if bar['h'] > self.peak_price_all:
+            self.peak_price_all = bar['h']
+            self.peak_price_ts = bar['ts']
+
+
+class MetricsRegistry:
+    """
+    RollingMetrics per key, fed with the deltas of a CandleStore.
+    """
+
+    def __init__(self, windows=TREND_WINDOWS):
+        self.windows = windows
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def on_candles(self, key, df, delta):
+        """
+        CandleStore listener.
+        @param key: tuple : (pair_id, time_bucket)
+        @param df: pd.DataFrame : the full candle history
+        @param delta: pd.DataFrame : the candles that were just fetched
+        """
+        with self._lock:
+            metrics = self.metrics.get(key)
+            if metrics is None:
+                self.metrics[key] = RollingMetrics.from_frame(df, self.windows)
+                return
+
+        metrics.update_frame(delta)
+
+    def snapshot(self, key, live=None) -> dict:
+        metrics = self.metrics.get(key)
+        return metrics.snapshot(live) if metrics is not None else None
@@ -0,0 +1,346 @@
+"""
+Rolling-origin backtest of model.predict over stored candle histories.
+
+    python backtest.py --engines prophet prophet-fast holt ar rw
+    python backtest.py --pairs 1 2 3 --engines prophet-fast --set PROPHET_WINDOW=500,1000,2000
+    python backtest.py --fixture data/candles/<pair_id>/15m/base.parquet --folds 50
+    python backtest.py --synthetic 8 --engines holt ar rw
+
+Every series is cut at --folds origins, --step bars apart, the last one
+--horizon bars before its last candle. At each origin the engine is fitted
+on the bars before it and the forecast compared with the --horizon bars
+after it. The folds of a series run in order in one worker process, the way
+the bot refits a pair as bars arrive, so warm starts count. Series, engines
+and settings run in parallel in a process pool.
+
+--set overrides module constants of model (PROPHET_WINDOW, WINDOW,
+INTERVAL_WIDTH, ...) inside the workers, every combination of the given
+values is a setting of its own.
+
+Per engine and setting the report has the MAPE, the share of the actual
+closes inside [yhat_lower, yhat_upper] against the nominal interval width,
+the directional hit rate of yhat against the last known close and the
+fit time percentiles. It is written as JSON to bench-results/ and the
+fastest setting within --max-mape and --min-coverage is named.
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from bench_pipeline import RESULTS_PATH, git_commit
+
+logger = logging.getLogger(__name__)
+
+# time_bucket -> (pandas freq, seconds)
+BUCKETS = {
+    '1m': ('1min', 60),
+    '5m': ('5min', 300),
+    '15m': ('15min', 900),
+    '1h': ('1h', 3600),
+    '4h': ('4h', 4 * 3600),
+    '1d': ('1D', 24 * 3600),
+}
+
+
+def origins(length: int, folds: int, step: int, horizon: int, min_history: int) -> list:
+    """
+    Row indexes to cut a series of length rows at, oldest first.
+    """
+    last = length - horizon
+    return [origin for origin in range(last - (folds - 1) * step, last + 1, step) if origin >= min_history]
+
+
+def parse_settings(assignments) -> list:
+    """
+    ['NAME=1,2', 'OTHER=0.5'] -> [{'NAME': 1, 'OTHER': 0.5}, {'NAME': 2, 'OTHER': 0.5}]
+    """
+    import model
+
+    axes = []
+    for assignment in assignments or ():
+        name, _, values = assignment.partition('=')
+        if not name.isupper() or not hasattr(model, name):
+            raise ValueError(f"model has no setting {name}")
+        axes.append([(name, _number(value)) for value in values.split(',')])
+
+    return [dict(combination) for combination in itertools.product(*axes)]
+
+
+def _number(value: str):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def setting_name(setting: dict) -> str:
+    return ','.join(f"{name}={value}" for name, value in setting.items()) or 'default'
+
+
+def run_series(series_id, df, engine, setting, cuts, horizon, freq, seconds) -> dict:
+    """
+    Forecast one series at every cut, runs inside a worker process.
+    @return: dict : yhat, yhat_lower, yhat_upper and actual as (folds, horizon) arrays,
+                    last (the close at the cut) as (folds, 1), fit_s and failures
+    """
+    import model
+
+    logging.getLogger('cmdstanpy').setLevel(logging.WARNING)
+    logging.getLogger('prophet').setLevel(logging.WARNING)
+
+    previous = {name: getattr(model, name) for name in setting}
+    for name, value in setting.items():
+        setattr(model, name, value)
+
+    ts = df['ts'].to_numpy()
+    close = df['c'].to_numpy(dtype=np.float64)
+    steps = np.arange(1, horizon + 1) * seconds
+    # a warm start is only taken from the same series and setting
+    key = ('backtest', series_id, setting_name(setting))
+
+    columns = {name: [] for name in ('yhat', 'yhat_lower', 'yhat_upper', 'actual', 'last')}
+    fit_s, failures = [], 0
+    try:
+        for cut in cuts:
+            history = df.iloc[:cut]
+            start = time.perf_counter()
+            try:
+                predicted = model.predict(history, horizon, freq, 'ts_utc', 'c', engine, key)
+            except Exception as e:
+                logger.warning(f"{engine} failed on {series_id} at {cut}: {e}")
+                failures += 1
+                continue
+            fit_s.append(time.perf_counter() - start)
+
+            # the actual closes at the forecast times, NaN where the bar is missing
+            expected = ts[cut - 1] + steps
+            index = np.minimum(np.searchsorted(ts, expected), len(ts) - 1)
+            actual = np.where(ts[index] == expected, close[index], np.nan)
+
+            for name in ('yhat', 'yhat_lower', 'yhat_upper'):
+                columns[name].append(predicted[name].to_numpy(dtype=np.float64)[:horizon])
+            columns['actual'].append(actual)
+            columns['last'].append(close[cut - 1:cut])
+    finally:
+        for name, value in previous.items():
+            setattr(model, name, value)
+
+    result = {name: np.array(values).reshape(len(values), -1) if values else np.empty((0, 1))
+              for name, values in columns.items()}
+    result.update(fit_s=fit_s, failures=failures)
+    return result
+
+
+def score(results: list, interval_width: float) -> dict:
+    """
+    Error metrics over all forecasts of one engine and setting.
+    @param results: list : run_series results
+    """
+    joined = {name: np.concatenate([r[name] for r in results if len(r[name])])
+              for name in ('yhat', 'yhat_lower', 'yhat_upper', 'actual', 'last')
+              if any(len(r[name]) for r in results)}
+    fit_s = np.array([s for r in results for s in r['fit_s']])
+    failures = sum(r['failures'] for r in results)
+
+    if not joined:
+        return {'forecasts': 0, 'failures': failures}
+
+    yhat, lower, upper = joined['yhat'], joined['yhat_lower'], joined['yhat_upper']
+    actual, last = joined['actual'], joined['last']
+    known = ~np.isnan(actual)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ape = np.abs(yhat - actual) / np.abs(actual)
+    ape[~known] = np.nan
+
+    inside = (actual >= lower) & (actual <= upper)
+
+    # the first step is anchored to the last close, the direction is judged from the second on
+    moved = np.sign(actual[:, 1:] - last)
+    called = np.sign(yhat[:, 1:] - last)
+    judged = known[:, 1:] & (moved != 0)
+
+    return {
+        'forecasts': int(len(yhat)),
+        'failures': failures,
+        'mape': float(np.nanmean(ape) * 100),
+        'mape_last_step': float(np.nanmean(ape[:, -1]) * 100),
+        'coverage': float(inside[known].mean()),
+        'nominal_coverage': interval_width,
+        'interval_width': float(np.nanmean((upper - lower)[known] / actual[known])),
+        'direction_hit_rate': float((called == moved)[judged].mean()) if judged.any() else None,
+        'fit_p50_s': float(np.percentile(fit_s, 50)),
+        'fit_p95_s': float(np.percentile(fit_s, 95)),
+        'fit_mean_s': float(fit_s.mean()),
+        'fit_total_s': float(fit_s.sum()),
+    }
+
+
+def load_series(args) -> dict:
+    """
+    @return: dict : series id -> candles with ts, c and ts_utc, sorted by ts
+    """
+    series = {}
+
+    if args.synthetic:
+        from bench import synthetic_candles
+        for seed in range(args.synthetic):
+            series[f"synthetic-{seed}"] = synthetic_candles(args.bars, seed)
+
+    for path in args.fixture or ():
+        from bench import load_fixture
+        series[os.path.basename(os.path.dirname(os.path.dirname(path))) or path] = load_fixture(path)
+
+    if not series or args.pairs:
+        # candles is imported by the store and reads the API key on import
+        os.environ.setdefault('TS_API_KEY', 'backtest')
+        from candle_store import CandleStore
+
+        store = CandleStore(args.store, fetch=lambda *a, **kw: pd.DataFrame())
+        pair_ids = args.pairs or sorted(int(name) for name in os.listdir(args.store)
+                                        if name.isdigit()
+                                        and os.path.isdir(os.path.join(args.store, name, args.time_bucket)))
+        for pair_id in pair_ids:
+            df = store.get_candles(pair_id, args.time_bucket)
+            if not df.empty:
+                df['ts_utc'] = pd.to_datetime(df['ts'], unit='s')
+                series[pair_id] = df
+
+    return series
+
+
+def run(args) -> dict:
+    import model
+
+    freq, seconds = BUCKETS[args.time_bucket]
+    settings = parse_settings(args.set) or [{}]
+    series = load_series(args)
+    if not series:
+        raise SystemExit(f"No candles found, fill {args.store} or use --fixture/--synthetic")
+
+    tasks = []
+    for series_id, df in series.items():
+        cuts = origins(len(df), args.folds, args.step, args.horizon, args.min_history)
+        if not cuts:
+            logger.warning(f"{series_id} has only {len(df)} bars, skipped")
+            continue
+        for engine, setting in itertools.product(args.engines, settings):
+            tasks.append((series_id, df, engine, setting, cuts, args.horizon, freq, seconds))
+
+    logger.warning(f"{len(tasks)} series runs of {len(series)} series, {args.workers or os.cpu_count()} workers")
+
+    results = {}
+    started = time.perf_counter()
+    # fork: the children inherit the loaded modules, as in worker.AnalysisPool
+    with ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = {executor.submit(run_series, *task): (task[2], setting_name(task[3])) for task in tasks}
+        for future in as_completed(futures):
+            results.setdefault(futures[future], []).append(future.result())
+    wall_s = time.perf_counter() - started
+
+    configurations = []
+    for (engine, name), engine_results in results.items():
+        setting = next(s for s in settings if setting_name(s) == name)
+        width = setting.get('INTERVAL_WIDTH', model.INTERVAL_WIDTH)
+        configurations.append({'engine': engine, 'setting': name, **score(engine_results, width)})
+    configurations.sort(key=lambda c: c.get('fit_p50_s', float('inf')))
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.time(),
+        'series': len(series),
+        'time_bucket': args.time_bucket,
+        'folds': args.folds,
+        'step': args.step,
+        'horizon': args.horizon,
+        'wall_s': wall_s,
+        'configurations': configurations,
+        'recommended': recommend(configurations, args.max_mape, args.min_coverage),
+    }
+
+    out = args.out or os.path.join(RESULTS_PATH, f"backtest-{report['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print_report(report)
+    print(f"\nWritten to {out}")
+    return report
+
+
+def recommend(configurations: list, max_mape=None, min_coverage=None) -> dict:
+    """
+    The fastest configuration within the limits, configurations are sorted by fit time.
+    """
+    for configuration in configurations:
+        if not configuration['forecasts']:
+            continue
+        if max_mape is not None and configuration['mape'] > max_mape:
+            continue
+        if min_coverage is not None and configuration['coverage'] < min_coverage:
+            continue
+        return {'engine': configuration['engine'], 'setting': configuration['setting']}
+    return None
+
+
+def print_report(report):
+    print(f"{'engine':<14}{'setting':<28}{'MAPE %':>9}{'last %':>9}{'cover':>8}"
+          f"{'hit':>7}{'fit p50':>10}{'fit p95':>10}{'fails':>7}")
+
+    for c in report['configurations']:
+        if not c['forecasts']:
+            print(f"{c['engine']:<14}{c['setting']:<28}{'-':>9}{'-':>9}{'-':>8}{'-':>7}{'-':>10}{'-':>10}{c['failures']:>7}")
+            continue
+
+        hit = f"{c['direction_hit_rate']:.2f}" if c['direction_hit_rate'] is not None else '-'
+        print(f"{c['engine']:<14}{c['setting']:<28}{c['mape']:>9.2f}{c['mape_last_step']:>9.2f}"
+              f"{c['coverage']:>8.2f}{hit:>7}{c['fit_p50_s'] * 1e3:>8.0f}ms{c['fit_p95_s'] * 1e3:>8.0f}ms"
+              f"{c['failures']:>7}")
+
+    recommended = report['recommended']
+    if recommended:
+        print(f"\nfastest within the limits: {recommended['engine']} {recommended['setting']}")
+    else:
+        print("\nno configuration within the limits")
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+
+    import model
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engines', nargs='+', choices=list(model.ENGINES), default=list(model.ENGINES))
+    parser.add_argument('--set', action='append', metavar='NAME=V1,V2',
+                        help='model setting to try, may be repeated')
+    parser.add_argument('--store', default=os.environ.get('CANDLE_STORE_PATH', 'data/candles'),
+                        help='CandleStore root to read the histories from')
+    parser.add_argument('--pairs', nargs='+', type=int, help='pair_ids in the store, all if not given')
+    parser.add_argument('--fixture', nargs='+', help='candle files (parquet or csv) instead of the store')
+    parser.add_argument('--synthetic', type=int, default=0, help='number of synthetic series instead of the store')
+    parser.add_argument('--bars', type=int, default=3000, help='bars per synthetic series')
+    parser.add_argument('--time-bucket', default='15m', choices=list(BUCKETS))
+    parser.add_argument('--folds', type=int, default=20, help='forecast origins per series')
+    parser.add_argument('--step', type=int, default=16, help='bars between two origins')
+    parser.add_argument('--horizon', type=int, default=30, help='bars forecast, the bot uses 30')
+    parser.add_argument('--min-history', type=int, default=200, help='fewest bars to fit on')
+    parser.add_argument('--workers', type=int, help='processes, defaults to the number of CPUs')
+    parser.add_argument('--max-mape', type=float, help='MAPE in %% a recommendation must stay under')
+    parser.add_argument('--min-coverage', type=float, help='band coverage a recommendation must reach')
+    parser.add_argument('--out', help='report path, defaults to bench-results/backtest-<commit>.json')
+
+    args = parser.parse_args()
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,439 @@
+import os
+import json
+import time
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+from web3 import Web3
+from eth_abi import decode
+from decouple import config
+
+from .multicall import Call, aggregate
+
+logger = logging.getLogger(__name__)
+
+WETH_ADDRESS = Web3.to_checksum_address('0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2')
+
+SWAP_TOPIC = Web3.keccak(text='Swap(address,uint256,uint256,uint256,uint256,address)')
+SYNC_TOPIC = Web3.keccak(text='Sync(uint112,uint112)')
+
+ONCHAIN_CHECKPOINT_PATH = config("ONCHAIN_CHECKPOINT_PATH", default="data/onchain")
+# how far back a pair without history is built from, in seconds
+ONCHAIN_BACKFILL = config("ONCHAIN_BACKFILL", default=7 * 24 * 3600, cast=int)
+# blocks behind the head that are not read yet, so a reorg does not leave stale bars
+ONCHAIN_CONFIRMATIONS = config("ONCHAIN_CONFIRMATIONS", default=2, cast=int)
+
+# eth_getLogs block range, adapted between 1 and LOG_BATCH_MAX_BLOCKS
+LOG_BATCH_BLOCKS = config("LOG_BATCH_BLOCKS", default=2000, cast=int)
+LOG_BATCH_MAX_BLOCKS = config("LOG_BATCH_MAX_BLOCKS", default=100000, cast=int)
+# most providers cap a response at 10000 logs, stay well below
+LOG_BATCH_TARGET = 5000
+
+TIME_BUCKETS = {
+    '1m': 60,
+    '5m': 300,
+    '15m': 900,
+    '1h': 3600,
+    '4h': 4 * 3600,
+    '1d': 24 * 3600,
+    '7d': 7 * 24 * 3600,
+}
+
+CANDLE_COLUMNS = ['ts', 'o', 'h', 'l', 'c', 'v', 'bv', 'sv', 'tc', 'b', 's']
+
+
+def block_at(w3, ts: int, latest=None) -> int:
+    """
+    The first block with a timestamp at or after ts, by binary search.
+    @param w3: Web3 : the web3 connection
+    @param ts: int : unix time
+    @param latest: int : the highest block to consider, defaults to the head
+    """
+    lo = 0
+    hi = w3.eth.block_number if latest is None else latest
+
+    if w3.eth.get_block(hi)['timestamp'] < ts:
+        return hi + 1
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if w3.eth.get_block(mid)['timestamp'] < ts:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def pair_info(w3, pair_address: str) -> tuple:
+    """
+    Which side of a Uniswap v2 pair is priced, and in what. The quote is WETH
+    if the pair has it, otherwise token1.
+    @param w3: Web3 : the web3 connection
+    @param pair_address: str : the pair contract address
+    @return: tuple : (base is token0, base decimals, quote decimals, quote is WETH)
+    """
+    token0, token1 = aggregate(w3, [
+        Call(pair_address, 'token0()', (), ['address']),
+        Call(pair_address, 'token1()', (), ['address']),
+    ])
+    if token0 is None or token1 is None:
+        raise ValueError(f"{pair_address} is not a Uniswap v2 pair")
+
+    base_is_token0 = Web3.to_checksum_address(token1) == WETH_ADDRESS \
+        or Web3.to_checksum_address(token0) != WETH_ADDRESS
+    base, quote = (token0, token1) if base_is_token0 else (token1, token0)
+
+    base_decimals, quote_decimals = aggregate(w3, [
+        Call(base, 'decimals()', (), ['uint8']),
+        Call(quote, 'decimals()', (), ['uint8']),
+    ])
+    return (base_is_token0, base_decimals or 0, quote_decimals or 0,
+            Web3.to_checksum_address(quote) == WETH_ADDRESS)
+
+
+def reserve_price(reserve0: int, reserve1: int, info: tuple) -> float:
+    """
+    Spot price of the base in the quote from a pair's reserves.
+    @param info: tuple : the pair_info of the pair
+    """
+    base_is_token0, base_decimals, quote_decimals, _ = info
+    base, quote = (reserve0, reserve1) if base_is_token0 else (reserve1, reserve0)
+    if not base:
+        return np.nan
+    return (quote * 10.0 ** -quote_decimals) / (base * 10.0 ** -base_decimals)
+
+
+class CandleBuilder:
+    """
+    OHLCV candles of one Uniswap v2 pair built from its Sync and Swap logs.
+
+    Prices are the spot price after every Sync, volumes come from the Swaps,
+    both in the quote token (WETH if the pair has it), or in USD when
+    quote_usd is given. Logs are read with eth_getLogs in block ranges that
+    shrink when the node refuses a range and grow while responses stay small.
+    The last block read and the last, possibly unfinished, bar are
+    checkpointed, so an update only reads the blocks after the checkpoint.
+    """
+
+    def __init__(self,
+                 w3,
+                 pair_address: str,
+                 time_bucket='15m',
+                 pair_id=None,
+                 quote_usd=None,
+                 path=ONCHAIN_CHECKPOINT_PATH,
+                 backfill=ONCHAIN_BACKFILL,
+                 confirmations=ONCHAIN_CONFIRMATIONS):
+        """
+        @param w3: Web3 : the web3 connection
+        @param pair_address: str : the Uniswap v2 pair
+        @param time_bucket: str : the candle interval, one of TIME_BUCKETS
+        @param pair_id: int : written to the p column if given
+        @param quote_usd: callable : returns the USD price of WETH, None to keep quote units
+        @param path: str : directory of the checkpoints, None to not persist them
+        @param backfill: int : seconds of history built for a pair without a checkpoint
+        @param confirmations: int : blocks behind the head that are not read yet
+        """
+        if time_bucket not in TIME_BUCKETS:
+            raise ValueError(f"Unsupported time_bucket {time_bucket}, expected one of {', '.join(TIME_BUCKETS)}")
+
+        self.w3 = w3
+        self.pair_address = Web3.to_checksum_address(pair_address)
+        self.time_bucket = time_bucket
+        self.seconds = TIME_BUCKETS[time_bucket]
+        self.pair_id = pair_id
+        self.quote_usd = quote_usd
+        self.backfill = backfill
+        self.confirmations = confirmations
+
+        self.checkpoint_path = (os.path.join(path, f"{self.pair_address.lower()}-{time_bucket}.json")
+                                if path else None)
+
+        self.batch = LOG_BATCH_BLOCKS
+        self.last_block = None
+        # in quote units, merged with the first bar of the next update
+        self.last_bar = None
+
+        self._pair = None
+        self._timestamps = {}
+
+        self._load()
+
+    def update(self, start_time=None, head=None) -> pd.DataFrame:
+        """
+        Read the new logs and return the bars they changed.
+        @param start_time: int : ts of the last bar the caller has, None to rebuild the backfill window
+        @param head: int : the last block to read, defaults to the head minus the confirmations
+        @return: pd.DataFrame : the changed bars, the first one may replace the caller's last bar
+        """
+        if head is None:
+            head = self.w3.eth.block_number - self.confirmations
+
+        if start_time is None:
+            # nothing stored downstream, build the whole window again
+            self.last_block = block_at(self.w3, int(time.time()) - self.backfill, head) - 1
+            self.last_bar = None
+        elif self.last_block is None or (self.last_bar is not None and self.last_bar['ts'] < start_time):
+            # no usable checkpoint, rebuild from the start of the caller's last bar
+            self.last_block = block_at(self.w3, int(start_time), head) - 1
+            self.last_bar = None
+
+        if head <= self.last_block:
+            return self._frame([])
+
+        events = self._events(self.last_block + 1, head)
+        bars = self._aggregate(events)
+
+        self.last_block = head
+        if bars:
+            self.last_bar = bars[-1]
+        self._save()
+
+        return self._frame(bars)
+
+    def get_logs(self, from_block: int, to_block: int):
+        """
+        Yield the Swap and Sync logs of the pair, one block range at a time.
+        """
+        while from_block <= to_block:
+            end = min(from_block + self.batch - 1, to_block)
+            try:
+                logs = self.w3.eth.get_logs({
+                    'address': self.pair_address,
+                    'topics': [[SWAP_TOPIC, SYNC_TOPIC]],
+                    'fromBlock': from_block,
+                    'toBlock': end,
+                })
+            except Exception as e:
+                # too many results, range too large or a timeout
+                if self.batch == 1:
+                    raise
+                self.batch = max(1, self.batch // 2)
+                logger.debug(f"eth_getLogs {from_block}-{end} failed ({e}), {self.batch} blocks per request")
+                continue
+
+            yield logs
+            from_block = end + 1
+
+            if len(logs) < LOG_BATCH_TARGET // 2:
+                self.batch = min(self.batch * 2, LOG_BATCH_MAX_BLOCKS)
+
+    def _pair_info(self) -> tuple:
+        """
+        @return: tuple : see pair_info
+        """
+        if self._pair is None:
+            self._pair = pair_info(self.w3, self.pair_address)
+        return self._pair
+
+    def _events(self, from_block: int, to_block: int) -> pd.DataFrame:
+        """
+        Decode the logs into one row per event: ts, price for Syncs, volume and side for Swaps.
+        """
+        info = self._pair_info()
+        base_is_token0, _, quote_decimals, _ = info
+        quote_scale = 10.0 ** -quote_decimals
+
+        rows = []
+        for logs in self.get_logs(from_block, to_block):
+            if not logs:
+                continue
+
+            timestamps = self._block_timestamps(logs)
+            for log in logs:
+                topic = bytes(log['topics'][0])
+                order = (log['blockNumber'], log['logIndex'])
+                ts = timestamps[log['blockNumber']]
+
+                if topic == bytes(SYNC_TOPIC):
+                    reserve0, reserve1 = decode(['uint112', 'uint112'], bytes(log['data']))
+                    price = reserve_price(reserve0, reserve1, info)
+                    rows.append((order, ts, price, 0.0, False, False))
+
+                elif topic == bytes(SWAP_TOPIC):
+                    in0, in1, out0, out1 = decode(['uint256'] * 4, bytes(log['data']))
+                    quote_in, quote_out = (in1, out1) if base_is_token0 else (in0, out0)
+                    base_out = out0 if base_is_token0 else out1
+                    # a buy pays quote for base
+                    volume = (quote_in + quote_out) * quote_scale
+                    rows.append((order, ts, np.nan, volume, True, base_out > 0))
+
+        rows.sort(key=lambda row: row[0])
+        self._timestamps.clear()
+
+        return pd.DataFrame([row[1:] for row in rows],
+                            columns=['ts', 'price', 'volume', 'swap', 'buy'])
+
+    def _block_timestamps(self, logs) -> dict:
+        """
+        Block number -> timestamp for the logs, from the logs themselves where
+        the node includes blockTimestamp, otherwise from the block headers.
+        """
+        for log in logs:
+            ts = log.get('blockTimestamp')
+            if ts is not None:
+                self._timestamps[log['blockNumber']] = int(ts, 16) if isinstance(ts, str) else int(ts)
+
+        missing = sorted({log['blockNumber'] for log in logs} - self._timestamps.keys())
+        if missing:
+            try:
+                with self.w3.batch_requests() as batch:
+                    for number in missing:
+                        batch.add(self.w3.eth.get_block(number))
+                    blocks = batch.execute()
+            except Exception as e:
+                logger.debug(f"Batched get_block failed ({e}), fetching blocks one by one")
+                blocks = [self.w3.eth.get_block(number) for number in missing]
+
+            for number, block in zip(missing, blocks):
+                self._timestamps[number] = int(block['timestamp'])
+
+        return self._timestamps
+
+    def _aggregate(self, events: pd.DataFrame) -> list:
+        """
+        Group the events into bars and merge the first one into the checkpointed bar.
+        @return: list : the bars as dicts, in quote units
+        """
+        if events.empty:
+            return []
+
+        events['bucket'] = events['ts'] // self.seconds * self.seconds
+        syncs = events[~events['swap']].groupby('bucket')['price']
+        swaps = events[events['swap']]
+        buys = swaps['volume'].where(swaps['buy'], 0.0)
+
+        bars = pd.DataFrame({
+            'o': syncs.first(),
+            'h': syncs.max(),
+            'l': syncs.min(),
+            'c': syncs.last(),
+            'v': swaps.groupby('bucket')['volume'].sum(),
+            'bv': buys.groupby(swaps['bucket']).sum(),
+            'tc': swaps.groupby('bucket').size(),
+            'b': swaps['buy'].groupby(swaps['bucket']).sum(),
+        }).sort_index()
+
+        # a bucket without a Sync keeps the previous close
+        previous_close = self.last_bar['c'] if self.last_bar else np.nan
+        bars['c'] = bars['c'].ffill().fillna(previous_close)
+        for column in ('o', 'h', 'l'):
+            bars[column] = bars[column].fillna(bars['c'])
+
+        bars[['v', 'bv', 'tc', 'b']] = bars[['v', 'bv', 'tc', 'b']].fillna(0)
+        bars['sv'] = bars['v'] - bars['bv']
+        bars['s'] = bars['tc'] - bars['b']
+        bars = bars.dropna(subset=['c'])
+
+        result = []
+        for ts, bar in bars.iterrows():
+            bar = {'ts': int(ts), **{column: float(bar[column]) for column in CANDLE_COLUMNS[1:]}}
+            for column in ('tc', 'b', 's'):
+                bar[column] = int(bar[column])
+            result.append(bar)
+
+        if result and self.last_bar and result[0]['ts'] == self.last_bar['ts']:
+            result[0] = self._merge(self.last_bar, result[0])
+
+        return result
+
+    @staticmethod
+    def _merge(bar: dict, later: dict) -> dict:
+        merged = dict(later)
+        merged['o'] = bar['o']
+        merged['h'] = max(bar['h'], later['h'])
+        merged['l'] = min(bar['l'], later['l'])
+        for column in ('v', 'bv', 'sv', 'tc', 'b', 's'):
+            merged[column] = bar[column] + later[column]
+        return merged
+
+    def _frame(self, bars: list) -> pd.DataFrame:
+        """
+        The bars with the same columns as candles.get_candles.
+        """
+        df = pd.DataFrame(bars, columns=CANDLE_COLUMNS)
+        df = df.astype({'ts': 'int64', 'tc': 'int64', 'b': 'int64', 's': 'int64'})
+
+        if self.quote_usd is not None and not df.empty:
+            if self._pair_info()[3]:
+                usd = float(self.quote_usd())
+                df[['o', 'h', 'l', 'c', 'v', 'bv', 'sv']] *= usd
+            else:
+                logger.warning(f"{self.pair_address} is not quoted in WETH, keeping quote units")
+
+        if self.pair_id is not None:
+            df.insert(0, 'p', int(self.pair_id))
+
+        df['ts_utc'] = pd.to_datetime(df['ts'], unit='s')
+        return df
+
+    def _load(self):
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return
+
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring checkpoint {self.checkpoint_path}: {e}")
+            return
+
+        self.last_block = checkpoint['last_block']
+        self.last_bar = checkpoint['last_bar']
+
+    def _save(self):
+        if not self.checkpoint_path:
+            return
+
+        os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'last_block': self.last_block, 'last_bar': self.last_bar}, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+
+class OnchainCandles:
+    """
+    A CandleStore fetch that builds the candles from the chain instead of
+    the TradingStrategy API, one CandleBuilder per pair and time_bucket.
+    """
+
+    def __init__(self, w3, pair_address, quote_usd=None, path=ONCHAIN_CHECKPOINT_PATH):
+        """
+        @param w3: Web3 : the web3 connection
+        @param pair_address: callable : pair_address(pair_id) returns the pair contract address
+        @param quote_usd: callable : returns the USD price of WETH, None to keep quote units
+        @param path: str : directory of the checkpoints
+        """
+        self.w3 = w3
+        self.pair_address = pair_address
+        self.quote_usd = quote_usd
+        self.path = path
+
+        self.builders = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, pair_id, time_bucket, start_time=None, end_time=None) -> pd.DataFrame:
+        """
+        Same signature as candles.get_candles.
+        """
+        key = (int(pair_id), time_bucket)
+        with self._lock:
+            builder = self.builders.get(key)
+            if builder is None:
+                builder = self.builders[key] = CandleBuilder(self.w3,
+                                                             self.pair_address(pair_id),
+                                                             time_bucket,
+                                                             pair_id=pair_id,
+                                                             quote_usd=self.quote_usd,
+                                                             path=self.path)
+
+        df = builder.update(start_time)
+        if start_time is not None:
+            df = df[df['ts'] >= int(start_time)]
+        if end_time is not None:
+            df = df[df['ts'] <= int(end_time)]
+
+        return df.reset_index(drop=True)
@@ -0,0 +1,252 @@
+import math
+import time
+import logging
+import threading
+
+import pandas as pd
+from web3 import Web3
+from decouple import config
+
+from .multicall import Call, aggregate
+from .candle_builder import TIME_BUCKETS, pair_info, reserve_price
+
+logger = logging.getLogger(__name__)
+
+# seconds between head checks, reserves are only read once per new block
+LIVE_POLL_INTERVAL = config("LIVE_POLL_INTERVAL", default=2.0, cast=float)
+# pairs not asked for during this many seconds stop being followed
+LIVE_IDLE = config("LIVE_IDLE", default=3600, cast=int)
+# a bar not updated for this many seconds is not served, e.g. while the node is down
+LIVE_MAX_AGE = config("LIVE_MAX_AGE", default=60, cast=int)
+
+PRICE_COLUMNS = ('o', 'h', 'l', 'c')
+# zero in a bar that only has reserves behind it
+VOLUME_COLUMNS = ('v', 'bv', 'sv', 'tc', 'b', 's')
+
+
+def merge_bar(df: pd.DataFrame, bar: dict) -> pd.DataFrame:
+    """
+    The candles with an in-progress bar on top. A bar with the same ts as the
+    last candle updates its high, low and close, a newer bar is appended
+    without volumes. The dataframe is not modified in place.
+    @param df: pd.DataFrame : the candle history, sorted by ts
+    @param bar: dict : see LiveTip.bar, None to return df as is
+    """
+    if bar is None or df.empty:
+        return df
+
+    last = df.iloc[-1]
+    last_ts = int(last['ts'])
+    if bar['ts'] < last_ts:
+        return df
+
+    if bar['ts'] == last_ts:
+        df = df.copy()
+        index = df.index[-1]
+        df.loc[index, 'h'] = max(float(last['h']), bar['h'])
+        df.loc[index, 'l'] = min(float(last['l']), bar['l'])
+        df.loc[index, 'c'] = bar['c']
+        return df
+
+    row = last.to_dict()
+    row.update({column: bar[column] for column in PRICE_COLUMNS})
+    row.update({column: 0 for column in VOLUME_COLUMNS if column in row})
+    row['ts'] = bar['ts']
+    if 'ts_utc' in row:
+        row['ts_utc'] = pd.Timestamp(bar['ts'], unit='s')
+
+    tip = pd.DataFrame([row], columns=df.columns).astype(df.dtypes.to_dict())
+    return pd.concat([df, tip], ignore_index=True)
+
+
+class LiveTip:
+    """
+    In-progress bars of the pairs being looked at, built from their reserves.
+
+    A daemon thread checks the head every poll_interval seconds and, once per
+    new block, reads getReserves of every followed pair in one multicall. The
+    spot price updates the open bar of the pair's current bucket, so the last
+    price is at most a block old without downloading any candles. The bars
+    carry prices only, volumes still come from the candle history.
+    """
+
+    def __init__(self,
+                 w3,
+                 time_bucket='15m',
+                 quote_usd=None,
+                 poll_interval=LIVE_POLL_INTERVAL,
+                 idle=LIVE_IDLE,
+                 max_age=LIVE_MAX_AGE,
+                 keep=None):
+        """
+        @param w3: Web3 : the web3 connection
+        @param time_bucket: str : the candle interval, one of TIME_BUCKETS
+        @param quote_usd: callable : returns the USD price of WETH, None to keep quote units
+        @param poll_interval: float : seconds between head checks
+        @param idle: float : seconds after the last use a pair stops being followed
+        @param max_age: float : seconds a bar is served after its last update
+        @param keep: callable : keep(pair_id) is True for pairs that are followed even when idle
+        """
+        if time_bucket not in TIME_BUCKETS:
+            raise ValueError(f"Unsupported time_bucket {time_bucket}, expected one of {', '.join(TIME_BUCKETS)}")
+
+        self.w3 = w3
+        self.time_bucket = time_bucket
+        self.seconds = TIME_BUCKETS[time_bucket]
+        self.quote_usd = quote_usd
+        self.poll_interval = poll_interval
+        self.idle = idle
+        self.max_age = max_age
+        self.keep = keep
+        # called as listener(pair_id, bar) from the polling thread after a bar changed
+        self.listeners = []
+
+        # pair_id -> {'address', 'info', 'bar', 'updated_at', 'used_at'}
+        self.pairs = {}
+        self.block = None
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def track(self, pair_id: int, pair_address: str):
+        """
+        Follow a pair, reading its reserves right away if it was not followed yet.
+        """
+        pair_id = int(pair_id)
+        with self._lock:
+            state = self.pairs.get(pair_id)
+            if state is not None:
+                state['used_at'] = time.time()
+                return
+
+        # token0/token1/decimals are read once per pair, outside the lock
+        address = Web3.to_checksum_address(pair_address)
+        info = pair_info(self.w3, address)
+
+        with self._lock:
+            self.pairs.setdefault(pair_id, {
+                'address': address,
+                'info': info,
+                'bar': None,
+                'updated_at': 0.0,
+                'used_at': time.time(),
+            })
+
+        self.poll([pair_id])
+
+    def bar(self, pair_id: int) -> dict:
+        """
+        The in-progress bar of a pair, in USD if quote_usd is set and the pair is quoted in WETH.
+        @return: dict : ts, o, h, l, c and block, None if the pair has no fresh bar
+        """
+        with self._lock:
+            state = self.pairs.get(int(pair_id))
+            if state is None or state['bar'] is None:
+                return None
+            if time.time() - state['updated_at'] > self.max_age:
+                return None
+            bar = dict(state['bar'])
+            quoted_in_weth = state['info'][3]
+
+        if self.quote_usd is not None and quoted_in_weth:
+            usd = float(self.quote_usd())
+            for column in PRICE_COLUMNS:
+                bar[column] *= usd
+
+        return bar
+
+    def merge(self, pair_id: int, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        The candles of a pair with its in-progress bar on top, see merge_bar.
+        """
+        return merge_bar(df, self.bar(pair_id))
+
+    def poll(self, pair_ids=None) -> bool:
+        """
+        Read the reserves at the head if it moved, or of pair_ids if given.
+        @param pair_ids: list : only read these pairs, at the current head
+        @return: bool : whether any bar was updated
+        """
+        block = self.w3.eth.get_block('latest')
+        number, timestamp = int(block['number']), int(block['timestamp'])
+
+        if pair_ids is None:
+            if number == self.block:
+                return False
+            self._expire()
+
+        with self._lock:
+            states = [(pair_id, self.pairs[pair_id]) for pair_id in (pair_ids or list(self.pairs))
+                      if pair_id in self.pairs]
+
+        if not states:
+            if pair_ids is None:
+                self.block = number
+            return False
+
+        results = aggregate(self.w3,
+                            [Call(state['address'], 'getReserves()', (), ['uint112', 'uint112', 'uint32'])
+                             for _, state in states],
+                            number)
+
+        bucket = timestamp // self.seconds * self.seconds
+        updated = []
+        with self._lock:
+            for (pair_id, state), reserves in zip(states, results):
+                if reserves is None:
+                    continue
+
+                price = reserve_price(reserves[0], reserves[1], state['info'])
+                if math.isnan(price):
+                    continue
+
+                bar = state['bar']
+                if bar is None or bucket > bar['ts']:
+                    state['bar'] = {'ts': bucket, 'o': price, 'h': price, 'l': price, 'c': price, 'block': number}
+                elif number >= bar['block']:
+                    bar.update(h=max(bar['h'], price), l=min(bar['l'], price), c=price, block=number)
+
+                state['updated_at'] = time.time()
+                updated.append(pair_id)
+
+        if pair_ids is None:
+            self.block = number
+
+        for listener in self.listeners:
+            for pair_id in updated:
+                try:
+                    listener(pair_id, self.bar(pair_id))
+                except Exception as e:
+                    logger.error(f"Live tip listener failed for {pair_id}: {e}")
+
+        return bool(updated)
+
+    def start(self):
+        """
+        Follow the head from a daemon thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._poll_loop,
+                                            name="live-tip",
+                                            daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _expire(self):
+        cutoff = time.time() - self.idle
+        with self._lock:
+            idle = [pair_id for pair_id, state in self.pairs.items()
+                    if state['used_at'] < cutoff and not (self.keep and self.keep(pair_id))]
+            for pair_id in idle:
+                del self.pairs[pair_id]
+
+    def _poll_loop(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception as e:
+                logger.warning(f"Live tip poll failed: {e}")
@@ -0,0 +1,94 @@
+from collections import namedtuple
+
+from web3 import Web3
+from eth_abi import encode, decode
+
+from .common import common_logger
+
+# Multicall3 is deployed at the same address on every major chain
+MULTICALL3_ADDRESS = Web3.to_checksum_address('0xcA11bde05977b3631167028862bE2a173976CA11')
+AGGREGATE3_SELECTOR = Web3.keccak(text='aggregate3((address,bool,bytes)[])')[:4]
+
+# calls per eth_call, keeps a single aggregate3 under the node's gas cap
+MULTICALL_CHUNK = 500
+
+# target: address, signature: 'getPair(address,address)', args: tuple, output_types: list of abi types
+Call = namedtuple('Call', ['target', 'signature', 'args', 'output_types'])
+
+
+def encode_call(call: Call) -> bytes:
+    selector = Web3.keccak(text=call.signature)[:4]
+    arg_types = call.signature[call.signature.index('(') + 1:-1]
+    arg_types = [t for t in arg_types.split(',') if t]
+    return bytes(selector) + encode(arg_types, list(call.args))
+
+
+def decode_result(call: Call, data: bytes):
+    values = decode(call.output_types, data)
+    return values[0] if len(values) == 1 else values
+
+
+def aggregate(w3, calls, block_identifier='latest') -> list:
+    """
+    Execute many read-only calls in one eth_call through Multicall3.
+    Calls that revert or can not be decoded return None.
+    Falls back to one eth_call per call if Multicall3 is not deployed.
+    @param w3: Web3 : the web3 connection
+    @param calls: list : the Calls to make
+    @return: list : the decoded results, in the order of calls
+    """
+    results = []
+    for i in range(0, len(calls), MULTICALL_CHUNK):
+        chunk = calls[i:i + MULTICALL_CHUNK]
+        try:
+            results.extend(_aggregate3(w3, chunk, block_identifier))
+        except Exception as e:
+            common_logger.warning(f"Multicall3 failed ({e}), falling back to single calls")
+            results.extend(_single_calls(w3, chunk, block_identifier))
+
+    return results
+
+
+def encode_aggregate3(calls) -> bytes:
+    """
+    Calldata of an aggregate3 call that allows every call to fail.
+    """
+    payload = encode(['(address,bool,bytes)[]'],
+                     [[(call.target, True, encode_call(call)) for call in calls]])
+    return bytes(AGGREGATE3_SELECTOR) + payload
+
+
+def _aggregate3(w3, calls, block_identifier) -> list:
+    raw = w3.eth.call({'to': MULTICALL3_ADDRESS,
+                       'data': encode_aggregate3(calls)},
+                      block_identifier)
+
+    # an empty return means there is no contract at MULTICALL3_ADDRESS
+    if not raw:
+        raise ValueError("empty response")
+
+    results = []
+    for call, (success, data) in zip(calls, decode(['(bool,bytes)[]'], raw)[0]):
+        results.append(_safe_decode(call, data) if success else None)
+
+    return results
+
+
+def _single_calls(w3, calls, block_identifier) -> list:
+    results = []
+    for call in calls:
+        try:
+            data = w3.eth.call({'to': call.target, 'data': encode_call(call)},
+                               block_identifier)
+            results.append(_safe_decode(call, data))
+        except Exception:
+            results.append(None)
+
+    return results
+
+
+def _safe_decode(call, data):
+    try:
+        return decode_result(call, data)
+    except Exception:
+        return None
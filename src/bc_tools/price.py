@@ -0,0 +1,162 @@
+import time
+import logging
+import threading
+
+import requests
+from web3 import Web3
+from eth_abi import decode
+from decouple import config
+
+from http_client import make_session
+
+logger = logging.getLogger(__name__)
+
+ETH_USD_TTL = config("ETH_USD_TTL", default=60, cast=int)
+
+# Uniswap v2 USDC/WETH, token0 is USDC (6 decimals), token1 is WETH (18 decimals)
+USDC_WETH_PAIR = Web3.to_checksum_address('0xB4e16d0168e52d35CaCD2c6185b44281Ec28C9Dc')
+GET_RESERVES_SELECTOR = Web3.keccak(text='getReserves()')[:4]
+
+session = make_session()
+
+COINGECKO_URL = config("COINGECKO_URL", default="https://api.coingecko.com/api/v3/simple/price")
+COINGECKO_PARAMS = {
+    "ids": "ethereum",
+    "vs_currencies": "usd"
+}
+
+
+def coingecko_eth_usd(timeout=10) -> float:
+    """
+    ETH price in USD from CoinGecko.
+    """
+    try:
+        response = session.get(COINGECKO_URL, params=COINGECKO_PARAMS, timeout=timeout)
+        data = response.json()
+
+        if response.status_code == 200:
+            eth_to_usd = data.get("ethereum", {}).get("usd")
+            if eth_to_usd is not None:
+                return eth_to_usd
+            else:
+                raise ValueError("Failed to fetch the exchange rate data.")
+        else:
+            raise ValueError(f"Failed to fetch data. Status code: {response.status_code}")
+    except requests.RequestException as e:
+        raise ValueError(f"Error occurred during the request: {e}")
+
+
+
+
+def onchain_eth_usd(w3) -> float:
+    """
+    ETH price in USD from the reserves of the Uniswap v2 USDC/WETH pair.
+    """
+    raw = w3.eth.call({'to': USDC_WETH_PAIR, 'data': bytes(GET_RESERVES_SELECTOR)})
+    usdc, weth, _ = decode(['uint112', 'uint112', 'uint32'], raw)
+    if not weth:
+        raise ValueError("USDC/WETH pair has no reserves")
+
+    return (usdc / 10 ** 6) / (weth / 10 ** 18)
+
+
+class PriceOracle:
+    """
+    Cached price with a short TTL.
+
+    Fresh prices are served from memory. A price older than ttl but younger
+    than max_age is still served while a background refresh runs.
+    Concurrent refreshes are coalesced into one request, and the sources are
+    tried in order until one answers.
+    """
+
+    def __init__(self, sources, ttl=ETH_USD_TTL, max_age=None):
+        """
+        @param sources: list : callables returning the price, tried in order
+        @param ttl: float : seconds a price is fresh
+        @param max_age: float : seconds a stale price may still be served, defaults to 10 * ttl
+        """
+        self.sources = list(sources)
+        self.ttl = ttl
+        self.max_age = max_age if max_age is not None else ttl * 10
+
+        self.price = None
+        self.updated_at = 0.0
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_source(self, source):
+        self.sources.append(source)
+
+    def get(self) -> float:
+        age = time.time() - self.updated_at
+
+        if self.price is not None and age < self.ttl:
+            return self.price
+
+        if self.price is not None and age < self.max_age:
+            self._refresh_async()
+            return self.price
+
+        return self.refresh()
+
+    def refresh(self) -> float:
+        """
+        Fetch a new price. Callers that arrive while a refresh is running
+        wait for it and share its result.
+        """
+        requested_at = time.time()
+
+        with self._lock:
+            if self.updated_at >= requested_at and self.price is not None:
+                return self.price
+
+            for source in self.sources:
+                try:
+                    price = float(source())
+                except Exception as e:
+                    logger.warning(f"Price source {getattr(source, '__name__', source)} failed: {e}")
+                    continue
+
+                self.price = price
+                self.updated_at = time.time()
+                return price
+
+        if self.price is not None:
+            logger.warning("All price sources failed, serving the last known price")
+            return self.price
+
+        raise ValueError("Failed to fetch the price from any source")
+
+    def start(self):
+        """
+        Keep the price fresh from a daemon thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refresh_loop,
+                                            name="price-oracle",
+                                            daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _refresh_async(self):
+        if self._lock.locked():
+            return
+        threading.Thread(target=self._safe_refresh, daemon=True).start()
+
+    def _safe_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"Price refresh failed: {e}")
+
+    def _refresh_loop(self):
+        while True:
+            self._safe_refresh()
+            if self._stop.wait(self.ttl * 0.9):
+                return
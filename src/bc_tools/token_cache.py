@@ -0,0 +1,81 @@
+import os
+import sqlite3
+import threading
+
+from web3 import Web3
+
+
+class TokenCache:
+    """
+    Persistent cache of the token data that never changes on chain:
+    decimals, name, symbol and the Uniswap pair address.
+    Stored in SQLite keyed by checksum address, with an in-memory layer in front.
+    """
+
+    FIELDS = ('decimals', 'name', 'symbol', 'pair_address')
+
+    def __init__(self, path):
+        """
+        @param path: str : the sqlite database file, ':memory:' for a throwaway cache
+        """
+        self.path = path
+        self._db = None
+        self._memory = {}
+        self._lock = threading.Lock()
+
+    def get(self, address):
+        """
+        @param address: str : the token address
+        @return: dict : the cached fields, None if the token is not cached
+        """
+        address = Web3.to_checksum_address(address)
+
+        data = self._memory.get(address)
+        if data is not None:
+            return data
+
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT decimals, name, symbol, pair_address FROM tokens WHERE address = ?",
+                (address,)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        data = dict(zip(TokenCache.FIELDS, row))
+        self._memory[address] = data
+        return data
+
+    def put(self, address, data: dict):
+        """
+        @param address: str : the token address
+        @param data: dict : at least the TokenCache.FIELDS
+        """
+        address = Web3.to_checksum_address(address)
+        data = {field: data[field] for field in TokenCache.FIELDS}
+
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO tokens (address, decimals, name, symbol, pair_address) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (address, *(data[field] for field in TokenCache.FIELDS))
+            )
+            db.commit()
+
+        self._memory[address] = data
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS tokens ("
+                "address TEXT PRIMARY KEY, decimals INTEGER, name TEXT, "
+                "symbol TEXT, pair_address TEXT)"
+            )
+        return self._db
@@ -0,0 +1,397 @@
+"""
+Micro benchmarks for the hot paths of the bot.
+
+    python bench.py decode --lines 2000000
+    python bench.py render --renders 10000
+    python bench.py startup --runs 5
+    python bench.py prophet --fixture data/candles/<pair_id>/15m/base.parquet
+    python bench.py alerts --alerts 200000
+"""
+import io
+import os
+import json
+import time
+import resource
+import argparse
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+
+def timed(fn, *args, repeat=3, **kwargs):
+    """
+    Run fn repeat times and return the best wall time and the last result.
+    """
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def rss_mb() -> float:
+    """
+    Current resident set size of this process in MB.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        # peak instead of current where /proc is not available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def synthetic_candles(bars: int, seed=0) -> pd.DataFrame:
+    """
+    Build a candles dataframe like candles.get_candles returns.
+    @param bars: int : the number of 15m candles
+    """
+    payload = synthetic_candles_jsonl(bars, seed)
+    df = pd.read_json(io.BytesIO(payload), lines=True)
+    df['ts'] = 1600000000 + np.arange(bars, dtype=np.int64) * 900
+    df['ts_utc'] = pd.to_datetime(df['ts'], unit='s')
+    return df
+
+
+def synthetic_candles_jsonl(lines: int, seed=0) -> bytes:
+    """
+    Build a candles-jsonl payload with the same fields as the TradingStrategy API.
+    @param lines: int : the number of candles
+    """
+    rng = np.random.default_rng(seed)
+    close = np.exp(np.cumsum(rng.normal(0, 0.01, lines)))
+    volume = rng.uniform(0, 1e5, lines)
+    buys = rng.integers(0, 50, lines)
+    sells = rng.integers(0, 50, lines)
+
+    df = pd.DataFrame({
+        'p': 1,
+        'ts': 1600000000 + np.arange(lines, dtype=np.int64) * 60,
+        'o': close,
+        'h': close * 1.01,
+        'l': close * 0.99,
+        'c': close,
+        'v': volume,
+        'bv': volume / 2,
+        'sv': volume / 2,
+        'tc': buys + sells,
+        'b': buys,
+        's': sells,
+    })
+
+    return df.to_json(orient='records', lines=True).encode()
+
+
+def decode_candles_loop(stream) -> pd.DataFrame:
+    """
+    The original per-row decoder of candles.get_candles, kept as a baseline.
+    """
+    import jsonlines
+
+    candle_data = defaultdict(list)
+    for item in jsonlines.Reader(stream):
+        for key, value in item.items():
+            candle_data[key].append(value)
+
+    return pd.DataFrame.from_dict(candle_data)
+
+
+def bench_decode(args):
+    from candles import decode_candles
+
+    payload = synthetic_candles_jsonl(args.lines)
+    print(f"payload: {args.lines} lines, {len(payload) / 1e6:.1f} MB")
+
+    loop_time, loop_df = timed(lambda: decode_candles_loop(io.BytesIO(payload)),
+                               repeat=args.repeat)
+    arrow_time, arrow_df = timed(lambda: decode_candles(io.BytesIO(payload)),
+                                 repeat=args.repeat)
+
+    pd.testing.assert_frame_equal(loop_df, arrow_df[loop_df.columns],
+                                  check_dtype=False)
+
+    report = {
+        'lines': args.lines,
+        'loop_s': loop_time,
+        'columnar_s': arrow_time,
+        'speedup': loop_time / arrow_time,
+    }
+    print(json.dumps(report, indent=2))
+    return report
+
+
+def bench_render(args):
+    from render import render
+
+    df = synthetic_candles(args.bars)
+    last = df['ts_utc'].iloc[-1]
+    ds = pd.date_range(last, periods=31, freq='15min')[1:]
+    yhat = np.full(30, df['c'].iloc[-1])
+    predicted_data = pd.DataFrame({'ds': ds, 'yhat': yhat,
+                                   'yhat_lower': yhat * 0.9, 'yhat_upper': yhat * 1.1})
+
+    options = dict(format=args.format, width=args.width, height=args.height, dpi=args.dpi)
+
+    report = {'renders': args.renders, **options}
+    for mode, reuse in (('template', True), ('new_figure', False)):
+        image = render(df, predicted_data, "72 hours", reuse=reuse, **options)
+        rss_start = rss_mb()
+
+        start = time.perf_counter()
+        for _ in range(args.renders):
+            render(df, predicted_data, "72 hours", reuse=reuse, **options).close()
+        elapsed = time.perf_counter() - start
+
+        report[mode] = {
+            'renders_per_s': args.renders / elapsed,
+            'image_bytes': image.getbuffer().nbytes,
+            'rss_start_mb': rss_start,
+            'rss_end_mb': rss_mb(),
+        }
+
+    print(json.dumps(report, indent=2))
+    return report
+
+
+def load_fixture(path: str) -> pd.DataFrame:
+    """
+    Load recorded candles, e.g. a CandleStore partition, csv or parquet.
+    """
+    if path.endswith('.csv'):
+        df = pd.read_csv(path)
+    else:
+        df = pd.read_parquet(path)
+
+    df = df.sort_values('ts').reset_index(drop=True)
+    df['ts_utc'] = pd.to_datetime(df['ts'], unit='s')
+    return df
+
+
+def bench_prophet(args):
+    import logging
+    import model
+
+    logging.getLogger('cmdstanpy').setLevel(logging.WARNING)
+
+    df = load_fixture(args.fixture) if args.fixture else synthetic_candles(args.bars)
+    # refit as every one of the last steps bars arrives, like the bot does
+    histories = [df.iloc[:len(df) - args.steps + i + 1] for i in range(args.steps)]
+
+    def fits(engine, key):
+        times, predictions = [], []
+        for history in histories:
+            start = time.perf_counter()
+            predictions.append(model.predict(history, args.period, '15min', 'ts_utc', 'c', engine, key))
+            times.append(time.perf_counter() - start)
+        return times, predictions
+
+    full_times, full = fits('prophet', None)
+    cold_times, _ = fits('prophet-fast', None)
+    warm_times, fast = fits('prophet-fast', ('bench', '15m'))
+
+    # warm fits after the first one, which has nothing to start from
+    warm_times = warm_times[1:] or warm_times
+
+    deviation = np.mean([np.mean(np.abs(f['yhat'].values / p['yhat'].values - 1))
+                         for f, p in zip(fast, full)])
+
+    report = {
+        'bars': len(df),
+        'steps': args.steps,
+        'prophet_s': statistics.median(full_times),
+        'fast_cold_s': statistics.median(cold_times),
+        'fast_warm_s': statistics.median(warm_times),
+        'speedup_cold': statistics.median(full_times) / statistics.median(cold_times),
+        'speedup_warm': statistics.median(full_times) / statistics.median(warm_times),
+        'yhat_mean_abs_deviation': float(deviation),
+    }
+    print(json.dumps(report, indent=2))
+    return report
+
+
+def bench_alerts(args):
+    import random
+    import tempfile
+    from alerts import AlertEngine
+
+    rng = random.Random(0)
+    prices = {pair_id: 10 ** rng.uniform(-9, 3) for pair_id in range(args.pairs)}
+
+    rss_before = rss_mb()
+    engine = AlertEngine(':memory:', max_per_chat=args.alerts)
+    start = time.perf_counter()
+    for i in range(args.alerts):
+        pair_id = rng.randrange(args.pairs)
+        price = prices[pair_id]
+        if i % 10 == 0:
+            engine.add_watch(i % 5000, pair_id, '0x', 'BENCH', price, rng.uniform(1, 20))
+        else:
+            engine.add_alert(i % 5000, pair_id, '0x', 'BENCH', 'price', price * rng.uniform(0.5, 1.5), price)
+    add_s = time.perf_counter() - start
+    rss_after = rss_mb()
+
+    # load the same alerts back from disk, like a restart does
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'alerts.sqlite')
+        disk = AlertEngine(path)
+        engine._db.backup(disk._connect())
+        load_s, _ = timed(lambda: AlertEngine(path).load(), repeat=1)
+
+    # one random walk step per update, on a random pair
+    times, fired = [], 0
+    for _ in range(args.updates):
+        pair_id = rng.randrange(args.pairs)
+        prices[pair_id] *= 1 + rng.gauss(0, args.volatility)
+        start = time.perf_counter()
+        fired += len(engine.update(pair_id, 'price', prices[pair_id]))
+        times.append(time.perf_counter() - start)
+
+    times.sort()
+    report = {
+        'alerts': args.alerts,
+        'pairs': args.pairs,
+        'adds_per_s': args.alerts / add_s,
+        'load_s': load_s,
+        'index_mb': rss_after - rss_before,
+        'updates': args.updates,
+        'fired': fired,
+        'update_p50_us': times[len(times) // 2] * 1e6,
+        'update_p99_us': times[int(len(times) * 0.99)] * 1e6,
+        'updates_per_s': args.updates / sum(times),
+        'alerts_left': len(engine),
+    }
+    print(json.dumps(report, indent=2))
+    return report
+
+
+# runs tg.main() up to the point it would start polling
+FIRST_POLL_SCRIPT = """
+import sys, json, time, asyncio
+import tg
+
+async def first_poll(*args, **kwargs):
+    print(json.dumps({
+        'first_poll': time.time(),
+        'loaded': [m for m in %r if m in sys.modules],
+    }), flush=True)
+
+tg.dp.start_polling = first_poll
+asyncio.run(tg.main())
+"""
+
+# modules tg should not import before the first poll
+HEAVY_MODULES = ('pandas', 'pyarrow', 'numpy', 'web3', 'matplotlib', 'prophet')
+
+
+def bot_env() -> dict:
+    env = dict(os.environ)
+    # a well formed placeholder, the bot never talks to telegram here
+    env.setdefault('BOT_TOKEN', '123456:placeholder')
+    return env
+
+
+def import_times(stderr: str) -> list:
+    """
+    Parse the output of python -X importtime into (cumulative_s, self_s, depth, module).
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # nesting is shown by indenting the name two spaces per level
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((int(cumulative_us) / 1e6, int(self_us) / 1e6, depth, name.strip()))
+    return rows
+
+
+def bench_startup(args):
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    env = bot_env()
+
+    first_poll = []
+    loaded = []
+    for _ in range(args.runs):
+        start = time.time()
+        out = subprocess.run([sys.executable, '-c', FIRST_POLL_SCRIPT % (HEAVY_MODULES,)],
+                             cwd=cwd, env=env, capture_output=True, text=True, check=True)
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        first_poll.append(result['first_poll'] - start)
+        loaded = result['loaded']
+
+    # where the remaining import time goes
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import tg'],
+                         cwd=cwd, env=env, capture_output=True, text=True, check=True)
+    rows = import_times(out.stderr)
+    # the modules tg imports directly
+    direct = sorted((row for row in rows if row[2] == 1), reverse=True)
+
+    # what the first analysis pays for the deferred imports
+    deferred = 'import time; import tg; t = time.perf_counter(); ' \
+               'import candles, candle_store, model, analytics, bc_tools.erc20; ' \
+               'print(time.perf_counter() - t)'
+    out = subprocess.run([sys.executable, '-c', deferred],
+                         cwd=cwd, env={'TS_API_KEY': '', **env}, capture_output=True, text=True, check=True)
+
+    report = {
+        'runs': args.runs,
+        'first_poll_s': {'min': min(first_poll), 'median': statistics.median(first_poll)},
+        'heavy_modules_loaded': loaded,
+        'deferred_import_s': float(out.stdout.strip().splitlines()[-1]),
+        'imports': [{'module': name, 'cumulative_s': cumulative, 'self_s': self_s}
+                    for cumulative, self_s, _, name in direct[:args.top]],
+    }
+    print(json.dumps(report, indent=2))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    decode = sub.add_parser('decode', help='candles-jsonl decoding')
+    decode.add_argument('--lines', type=int, default=2_000_000)
+    decode.add_argument('--repeat', type=int, default=3)
+    decode.set_defaults(func=bench_decode)
+
+    render = sub.add_parser('render', help='chart rendering throughput and memory')
+    render.add_argument('--renders', type=int, default=10_000)
+    render.add_argument('--bars', type=int, default=2000)
+    render.add_argument('--format', default='jpg', help='jpg, png or webp')
+    render.add_argument('--width', type=int, default=640)
+    render.add_argument('--height', type=int, default=480)
+    render.add_argument('--dpi', type=int, default=100)
+    render.set_defaults(func=bench_render)
+
+    startup = sub.add_parser('startup', help='bot time to first poll and import times')
+    startup.add_argument('--runs', type=int, default=5)
+    startup.add_argument('--top', type=int, default=10)
+    startup.set_defaults(func=bench_startup)
+
+    prophet = sub.add_parser('prophet', help='prophet against prophet-fast refits')
+    prophet.add_argument('--fixture', help='recorded candles (parquet or csv), synthetic if not given')
+    prophet.add_argument('--bars', type=int, default=3000)
+    prophet.add_argument('--steps', type=int, default=5)
+    prophet.add_argument('--period', type=int, default=30)
+    prophet.set_defaults(func=bench_prophet)
+
+    alerts = sub.add_parser('alerts', help='alert engine indexing and evaluation')
+    alerts.add_argument('--alerts', type=int, default=200_000)
+    alerts.add_argument('--pairs', type=int, default=1000)
+    alerts.add_argument('--updates', type=int, default=100_000)
+    alerts.add_argument('--volatility', type=float, default=0.01, help='stdev of a price step')
+    alerts.set_defaults(func=bench_alerts)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
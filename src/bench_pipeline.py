@@ -0,0 +1,515 @@
+"""
+Benchmark of the /ca pipeline against recorded fixtures served by local stubs.
+
+    python bench_pipeline.py fixtures --out fixtures
+    python bench_pipeline.py run --fixtures fixtures --requests 50 --concurrency 4
+    python bench_pipeline.py run --fixtures fixtures --record https://<rpc>
+
+A fixtures directory holds:
+
+    tokens.json             token addresses to analyse
+    pair-universe.parquet   the pair universe
+    candles.jsonl           candles-jsonl of the pairs of the tokens
+    rpc.json                JSON-RPC transcript, [{"method", "params", "result"}, ...]
+    coingecko.json          the simple/price response
+
+`fixtures` writes a synthetic set. With --record, RPC requests missing from
+the transcript are forwarded to a real node and added to rpc.json.
+Every stage and the end-to-end analyse_ca run --requests times from
+--concurrency threads, the report (p50/p95/p99 latency, throughput, peak
+RSS) is written as JSON to bench-results/ in the repository root.
+"""
+import os
+import json
+import time
+import socket
+import asyncio
+import hashlib
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESULTS_PATH = os.path.join(HERE, '..', 'bench-results')
+
+STAGES = ('erc20', 'pair_id', 'candles', 'candle_store', 'predict',
+          'render', 'analytics', 'eth_usd', 'pipeline')
+
+
+def rpc_key(method, params) -> str:
+    # web3 may send addresses checksummed or not, compare case-insensitively
+    return f"{method}:{json.dumps(params, sort_keys=True).lower()}"
+
+
+class Transcript:
+    """
+    Recorded JSON-RPC responses, optionally recording misses from an upstream node.
+    """
+
+    def __init__(self, path, upstream=None):
+        self.path = path
+        self.upstream = upstream
+        self.recorded = 0
+        self.misses = 0
+
+        self.entries = []
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+        self.index = {rpc_key(e['method'], e['params']): e['result'] for e in self.entries}
+
+        self._lock = threading.Lock()
+
+    def answer(self, request: dict) -> dict:
+        key = rpc_key(request['method'], request.get('params', []))
+        response = {'jsonrpc': '2.0', 'id': request.get('id')}
+
+        if key in self.index:
+            response['result'] = self.index[key]
+        elif self.upstream:
+            response['result'] = self._record(request, key)
+        else:
+            self.misses += 1
+            logger.warning(f"Not in transcript: {key[:200]}")
+            response['error'] = {'code': -32000, 'message': 'not in transcript'}
+
+        return response
+
+    def save(self):
+        if self.recorded:
+            with open(self.path, 'w') as f:
+                json.dump(self.entries, f, indent=1)
+
+    def _record(self, request, key):
+        from http_client import session
+
+        upstream = session.post(self.upstream, json={**request, 'id': 1}).json()
+        if 'error' in upstream:
+            raise ValueError(upstream['error'])
+
+        with self._lock:
+            self.entries.append({'method': request['method'],
+                                 'params': request.get('params', []),
+                                 'result': upstream['result']})
+            self.index[key] = upstream['result']
+            self.recorded += 1
+        return upstream['result']
+
+
+class Stubs:
+    """
+    Local stand-ins for the TradingStrategy API, CoinGecko and the RPC node,
+    served from the fixtures by an aiohttp server on its own thread.
+    """
+
+    def __init__(self, fixtures, upstream=None):
+        import pandas as pd
+
+        self.fixtures = fixtures
+        self.transcript = Transcript(os.path.join(fixtures, 'rpc.json'), upstream)
+
+        with open(os.path.join(fixtures, 'pair-universe.parquet'), 'rb') as f:
+            self.universe = f.read()
+        self.universe_etag = f'"{hashlib.sha1(self.universe).hexdigest()}"'
+
+        with open(os.path.join(fixtures, 'coingecko.json')) as f:
+            self.coingecko = json.load(f)
+
+        # candles-jsonl lines per pair with their ts, for start_time/end_time lookups
+        self.candles = {}
+        with open(os.path.join(fixtures, 'candles.jsonl'), 'rb') as f:
+            lines = f.read().splitlines(keepends=True)
+        df = pd.read_json(os.path.join(fixtures, 'candles.jsonl'), lines=True)
+        for pair_id, rows in df.groupby('p').indices.items():
+            rows = np.sort(rows)
+            self.candles[int(pair_id)] = (df['ts'].to_numpy()[rows], [lines[i] for i in rows])
+
+        # bound up front so the urls are known before the app modules read them
+        self.socket = socket.socket()
+        self.socket.bind(('127.0.0.1', 0))
+        self.url = f"http://127.0.0.1:{self.socket.getsockname()[1]}"
+
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    def env(self) -> dict:
+        return {
+            'RPC': f"{self.url}/rpc",
+            'TS_API_URL': f"{self.url}/api",
+            'COINGECKO_URL': f"{self.url}/coingecko/simple/price",
+        }
+
+    def start(self):
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._serve, args=(ready,), name="stubs", daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+        self.transcript.save()
+
+    def _serve(self, ready):
+        from aiohttp import web
+
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+
+        app = web.Application()
+        app.router.add_get('/api/pair-universe', self._pair_universe)
+        app.router.add_get('/api/candles-jsonl', self._candles)
+        app.router.add_get('/coingecko/simple/price', self._coingecko)
+        app.router.add_post('/rpc', self._rpc)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        self._loop.run_until_complete(web.SockSite(self._runner, self.socket).start())
+        ready.set()
+        self._loop.run_forever()
+        self._loop.close()
+
+    async def _pair_universe(self, request):
+        from aiohttp import web
+
+        if request.headers.get('If-None-Match') == self.universe_etag:
+            return web.Response(status=304)
+        return web.Response(body=self.universe, headers={'ETag': self.universe_etag})
+
+    async def _candles(self, request):
+        from aiohttp import web
+
+        start_time = int(request.query.get('start_time', 0))
+        end_time = int(request.query.get('end_time', 2**62))
+
+        body = []
+        for pair_id in request.query['pair_ids'].split(','):
+            ts, lines = self.candles.get(int(pair_id), (np.array([], dtype=np.int64), []))
+            first, last = np.searchsorted(ts, [start_time, end_time + 1])
+            body += lines[first:last]
+
+        return web.Response(body=b''.join(body))
+
+    async def _coingecko(self, request):
+        from aiohttp import web
+        return web.json_response(self.coingecko)
+
+    async def _rpc(self, request):
+        from aiohttp import web
+
+        payload = await request.json()
+        requests = payload if isinstance(payload, list) else [payload]
+
+        if self.transcript.upstream:
+            # recording blocks on the upstream node, keep it off the loop
+            answers = await asyncio.to_thread(lambda: [self.transcript.answer(r) for r in requests])
+        else:
+            answers = [self.transcript.answer(r) for r in requests]
+
+        return web.json_response(answers if isinstance(payload, list) else answers[0])
+
+
+def make_fixtures(args):
+    """
+    Write a synthetic fixtures directory whose transcript answers every call
+    analyse_ca makes for its tokens.
+    """
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from eth_abi import encode
+    from web3 import Web3
+
+    from bench import synthetic_candles
+    from bc_tools.erc20 import ERC20
+    from bc_tools.multicall import MULTICALL3_ADDRESS, Call, encode_aggregate3
+    from bc_tools.price import USDC_WETH_PAIR, GET_RESERVES_SELECTOR
+
+    os.makedirs(args.out, exist_ok=True)
+    now = int(time.time()) // 900 * 900
+    # the head the live tip reads the reserves at
+    head = 20_000_000
+
+    tokens, pairs, frames, transcript = [], [], [], []
+
+    def eth_call(to, data, result, block='latest'):
+        transcript.append({'method': 'eth_call',
+                           'params': [{'to': to, 'data': '0x' + data.hex()}, block],
+                           'result': '0x' + result.hex()})
+
+    def multicall(calls, results, block='latest'):
+        eth_call(MULTICALL3_ADDRESS, encode_aggregate3(calls),
+                 encode(['(bool,bytes)[]'], [[(True, result) for result in results]]), block)
+
+    for i in range(args.tokens):
+        token = Web3.to_checksum_address(Web3.keccak(text=f"token-{i}")[12:])
+        pair = ERC20.compute_pair_address(token, ERC20.WETH_ADDRESS)
+        pair_id = 1000 + i
+        supply = 10 ** 9 * 10 ** 18
+
+        tokens.append(token)
+        pairs.append({'pair_id': pair_id, 'address': pair.lower(), 'exchange_id': 1, 'chain_id': 1,
+                      'token0_address': min(token, ERC20.WETH_ADDRESS).lower(),
+                      'token1_address': max(token, ERC20.WETH_ADDRESS).lower()})
+
+        df = synthetic_candles(args.bars, seed=i).drop(columns=['ts_utc'])
+        df['p'] = pair_id
+        df['ts'] = now - (args.bars - 1 - np.arange(args.bars)) * 900
+        frames.append(df)
+
+        returns = {
+            'totalSupply()': encode(['uint256'], [supply]),
+            'getReserves()': encode(['uint112', 'uint112', 'uint32'], [10 ** 30, 50 * 10 ** 18, now]),
+            'decimals()': encode(['uint8'], [18]),
+            'name()': encode(['string'], [f"Token {i}"]),
+            'symbol()': encode(['string'], [f"TKN{i}"]),
+            'getPair(address,address)': encode(['address'], [pair]),
+        }
+
+        # the first read fetches everything, later ones hit the token cache
+        cached = {'pair_address': pair}
+        for cache in (None, cached):
+            _, calls = ERC20.token_calls(token, cache)
+            multicall(calls, [returns[call.signature] for call in calls])
+
+        # the live tip: the pair's tokens and decimals, then its reserves at the head
+        token0, token1 = sorted([token, ERC20.WETH_ADDRESS], key=str.lower)
+        multicall([Call(pair, 'token0()', (), ['address']), Call(pair, 'token1()', (), ['address'])],
+                  [encode(['address'], [token0]), encode(['address'], [token1])])
+        multicall([Call(token, 'decimals()', (), ['uint8']), Call(ERC20.WETH_ADDRESS, 'decimals()', (), ['uint8'])],
+                  [returns['decimals()'], encode(['uint8'], [18])])
+        multicall([Call(pair, 'getReserves()', (), ['uint112', 'uint112', 'uint32'])],
+                  [returns['getReserves()']], hex(head))
+
+    eth_call(USDC_WETH_PAIR, bytes(GET_RESERVES_SELECTOR),
+             encode(['uint112', 'uint112', 'uint32'], [3 * 10 ** 13, 10 ** 22, now]))
+    transcript.append({'method': 'eth_chainId', 'params': [], 'result': '0x1'})
+    transcript.append({'method': 'eth_getBlockByNumber', 'params': ['latest', False],
+                       'result': {'number': hex(head), 'timestamp': hex(now),
+                                  'hash': '0x' + Web3.keccak(text=f"block-{head}").hex().removeprefix('0x'),
+                                  'parentHash': '0x' + '00' * 32, 'transactions': []}})
+
+    pq.write_table(pa.Table.from_pylist(pairs), os.path.join(args.out, 'pair-universe.parquet'))
+    pd.concat(frames).to_json(os.path.join(args.out, 'candles.jsonl'), orient='records', lines=True)
+
+    for name, content in (('tokens.json', tokens),
+                          ('rpc.json', transcript),
+                          ('coingecko.json', {'ethereum': {'usd': 3000.0}})):
+        with open(os.path.join(args.out, name), 'w') as f:
+            json.dump(content, f, indent=1)
+
+    print(f"Wrote {args.tokens} tokens, {args.bars} candles each, to {args.out}")
+
+
+def peak_rss_mb() -> dict:
+    # ru_maxrss is in KB on Linux
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def measure(fn, items, requests: int, concurrency: int) -> dict:
+    """
+    Call fn on the items round robin, requests times from concurrency threads.
+    """
+    latencies = []
+    errors = []
+
+    def one(i):
+        start = time.perf_counter()
+        try:
+            fn(items[i % len(items)])
+        except Exception as e:
+            errors.append(repr(e))
+            return
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    wall = time.perf_counter() - start
+
+    report = {
+        'requests': requests,
+        'errors': len(errors),
+        'throughput_per_s': len(latencies) / wall,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    if latencies:
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        report.update(p50_s=p50, p95_s=p95, p99_s=p99,
+                      mean_s=float(np.mean(latencies)), max_s=max(latencies))
+    if errors:
+        report['first_error'] = errors[0]
+    return report
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    stubs = Stubs(args.fixtures, upstream=args.record)
+    workdir = tempfile.mkdtemp(prefix='bench-pipeline-')
+
+    # everything the app modules read from the environment, before they are imported
+    os.environ.update(stubs.env())
+    os.environ.setdefault('BOT_TOKEN', '123456:placeholder')
+    os.environ.setdefault('TS_API_KEY', 'bench')
+    os.environ.update({
+        'PAIR_UNIVERSE_PATH': os.path.join(workdir, 'pair-universe.parquet'),
+        'CANDLE_STORE_PATH': os.path.join(workdir, 'candles'),
+        'TOKEN_CACHE_PATH': os.path.join(workdir, 'tokens.sqlite'),
+    })
+    # the transcript has a single head, polling it again would only re-read it
+    os.environ.setdefault('LIVE_POLL_INTERVAL', '3600')
+    if not args.warm_caches:
+        # every request does the full work
+        os.environ.update({'FORECAST_CACHE_SIZE': '0', 'CANDLE_MAX_AGE': '0'})
+
+    import tg
+    # fork the workers before any other thread runs
+    tg.pool.start()
+    stubs.start()
+
+    import candles
+    import model
+    import render
+    import analytics
+    from bc_tools import common
+    from bc_tools.erc20 import ERC20
+
+    with open(os.path.join(args.fixtures, 'tokens.json')) as f:
+        tokens = json.load(f)
+
+    # inputs of the later stages, prepared outside the timings
+    w3 = tg.w3.get()
+    pairs = [ERC20.read_many(w3, [token])[0]['pair_address'] for token in tokens]
+    pair_ids = [tg.pair_universe.get_pair_id(pair) for pair in pairs]
+    frames = [candles.get_candles(pair_id, '15m') for pair_id in pair_ids]
+    predictions = [model.predict(df, 30, '15min', 'ts_utc', 'c', args.engine) for df in frames]
+
+    stages = {
+        'erc20': (lambda token: ERC20.read_many(w3, [token]), tokens),
+        'pair_id': (tg.pair_universe.get_pair_id, pairs),
+        'candles': (lambda pair_id: candles.get_candles(pair_id, '15m'), pair_ids),
+        'candle_store': (lambda pair_id: tg.candle_store.get_candles(pair_id, '15m'), pair_ids),
+        'predict': (lambda df: model.predict(df, 30, '15min', 'ts_utc', 'c', args.engine), frames),
+        'render': (lambda i: render.render(frames[i], predictions[i], "72 hours").getvalue(),
+                   range(len(frames))),
+        'analytics': (lambda df: analytics.compute(df, now=int(df['ts'].iloc[-1])), frames),
+        'eth_usd': (lambda _: common.eth_usd(10 ** 18), [None]),
+        'pipeline': (lambda token: tg.analyse_ca(token, args.engine), tokens),
+    }
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.time(),
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'engine': args.engine or model.FORECAST_ENGINE,
+        'warm_caches': args.warm_caches,
+        'tokens': len(tokens),
+        'stages': {},
+    }
+
+    try:
+        for name in args.stages:
+            fn, items = stages[name]
+            logger.info(f"Stage {name}")
+            report['stages'][name] = measure(fn, list(items), args.requests, args.concurrency)
+    finally:
+        tg.pool.shutdown()
+        stubs.stop()
+
+    report['rpc_misses'] = stubs.transcript.misses
+    report['peak_rss_mb'] = peak_rss_mb()
+
+    out = args.out or os.path.join(RESULTS_PATH, f"pipeline-{report['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print_report(report, load_baseline(args.baseline))
+    print(f"\nWritten to {out}")
+    return report
+
+
+def load_baseline(path):
+    if not path:
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def print_report(report, baseline=None):
+    print(f"{'stage':<14}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'errors':>8}"
+          + (f"{'p50 vs base':>14}" if baseline else ''))
+
+    for name, stage in report['stages'].items():
+        if 'p50_s' not in stage:
+            print(f"{name:<14}{'-':>10}{'-':>10}{'-':>10}{0:>10.1f}{stage['errors']:>8}")
+            continue
+
+        line = (f"{name:<14}{stage['p50_s'] * 1e3:>10.1f}{stage['p95_s'] * 1e3:>10.1f}"
+                f"{stage['p99_s'] * 1e3:>10.1f}{stage['throughput_per_s']:>10.1f}{stage['errors']:>8}")
+
+        base = (baseline or {}).get('stages', {}).get(name, {})
+        if 'p50_s' in base:
+            line += f"{stage['p50_s'] / base['p50_s'] - 1:>+13.0%}"
+        print(line)
+
+    rss = report['peak_rss_mb']
+    print(f"\npeak RSS: {rss['self']:.0f} MB, workers {rss['children']:.0f} MB")
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    fixtures = sub.add_parser('fixtures', help='write synthetic fixtures')
+    fixtures.add_argument('--out', default='fixtures')
+    fixtures.add_argument('--tokens', type=int, default=8)
+    fixtures.add_argument('--bars', type=int, default=3000)
+    fixtures.set_defaults(func=make_fixtures)
+
+    bench = sub.add_parser('run', help='run the stages against the fixtures')
+    bench.add_argument('--fixtures', default='fixtures')
+    bench.add_argument('--requests', type=int, default=50)
+    bench.add_argument('--concurrency', type=int, default=4)
+    bench.add_argument('--engine', help='forecasting engine, defaults to FORECAST_ENGINE')
+    bench.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    bench.add_argument('--warm-caches', action='store_true',
+                       help='keep the forecast cache and CANDLE_MAX_AGE as configured')
+    bench.add_argument('--record', metavar='RPC_URL',
+                       help='forward RPC requests missing from the transcript and record them')
+    bench.add_argument('--baseline', help='earlier report to compare the p50s with')
+    bench.add_argument('--out', help='report path, defaults to bench-results/pipeline-<commit>.json')
+    bench.set_defaults(func=run)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
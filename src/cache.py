@@ -0,0 +1,129 @@
+import os
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with a TTL and an optional on-disk tier.
+
+    Entries are evicted when they are older than ttl or when more than
+    maxsize entries are held in memory. With a path, entries are also
+    pickled to disk, so they survive restarts and memory evictions.
+    """
+
+    def __init__(self, maxsize=256, ttl=None, path=None):
+        """
+        @param maxsize: int : maximum number of entries held in memory
+        @param ttl: float : seconds an entry stays valid, None for no expiry
+        @param path: str : directory for the on-disk tier, None to disable it
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+
+        self.hits = 0
+        self.misses = 0
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def get(self, key, default=None):
+        now = time.time()
+
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or expires_at > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+
+        entry = self._read(key, now)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._insert(key, entry)
+            return entry[1]
+
+    def put(self, key, value):
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+
+        with self._lock:
+            self._insert(key, (expires_at, value))
+
+        self._write(key, (expires_at, value))
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+        return entry is not None and (entry[0] is None or entry[0] > time.time())
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'hit_ratio': self.hits / total if total else 0.0,
+        }
+
+    def _insert(self, key, entry):
+        self._data[key] = entry
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def _fname(self, key) -> str:
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.path, f"{digest}.pkl")
+
+    def _read(self, key, now):
+        if not self.path:
+            return None
+
+        try:
+            with open(self._fname(key), 'rb') as f:
+                stored_key, expires_at, value = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return None
+
+        if stored_key != key:
+            return None
+
+        if expires_at is not None and expires_at <= now:
+            try:
+                os.remove(self._fname(key))
+            except OSError:
+                pass
+            return None
+
+        return expires_at, value
+
+    def _write(self, key, entry):
+        if not self.path:
+            return
+
+        fname = self._fname(key)
+        tmp = f"{fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump((key, *entry), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, fname)
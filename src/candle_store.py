@@ -0,0 +1,172 @@
+import os
+import glob
+import time
+import threading
+import logging
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from decouple import config
+
+import candles
+from instrument import stage
+
+logger = logging.getLogger(__name__)
+
+CANDLE_STORE_PATH = config("CANDLE_STORE_PATH", default="data/candles")
+CANDLE_STORE_COMPACT_AFTER = config("CANDLE_STORE_COMPACT_AFTER", default=32, cast=int)
+
+
+class CandleStore:
+    """
+    On-disk candle store partitioned by pair_id and time_bucket.
+
+    Each partition is a directory holding a compacted base.parquet plus
+    the delta files appended since the last compaction. Only the bars after
+    the last known ts are requested from the API.
+    """
+
+    def __init__(self,
+                 root=CANDLE_STORE_PATH,
+                 compact_after=CANDLE_STORE_COMPACT_AFTER,
+                 fetch=candles.get_candles):
+        """
+        @param root: str : the directory to store the partitions in
+        @param compact_after: int : number of delta files after which a partition is compacted
+        @param fetch: callable : fetches candles, same signature as candles.get_candles
+        """
+        self.root = root
+        self.compact_after = compact_after
+        self.fetch = fetch
+
+        # called with (key, df, delta) after new candles were appended
+        self.listeners = []
+
+        self._frames = {}
+        self._fetched_at = {}
+        self._deltas = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    @stage('candle_store')
+    def get_candles(self, pair_id, time_bucket, max_age=None) -> pd.DataFrame:
+        """
+        Get the full candle history for a pair, fetching only the new bars.
+        @param pair_id: int : the pair_id to get candles for
+        @param time_bucket: str : the interval of the candles (1m, 5m, 15m, 1h, etc.)
+        @param max_age: float : skip the API if the pair was fetched less than max_age seconds ago
+        """
+        key = (int(pair_id), time_bucket)
+
+        with self._lock(key):
+            df = self._frames.get(key)
+            if df is not None and max_age is not None \
+                    and time.time() - self._fetched_at.get(key, 0) < max_age:
+                return df.copy()
+
+            if df is None:
+                df = self._read(key)
+
+            # refetch the last bar too, it may still have been in progress
+            start_time = int(df['ts'].iloc[-1]) if not df.empty else None
+            delta = self.fetch(pair_id, time_bucket, start_time=start_time)
+
+            if not delta.empty and not self._unchanged(df, delta):
+                # a refetch of the in-progress bar alone is kept in memory, the
+                # next refetch starts from that bar and writes it with the new ones
+                new_bars = df.empty or int(delta['ts'].max()) > int(df['ts'].iloc[-1])
+                df = self._merge(df, delta)
+
+                if new_bars:
+                    logger.info(f"Appending {len(delta)} candles to {key}")
+                    self._write_delta(key, delta)
+
+                    if self._deltas[key] >= self.compact_after:
+                        self._compact(key, df)
+
+                for listener in self.listeners:
+                    listener(key, df, delta)
+
+            self._frames[key] = df
+            self._fetched_at[key] = time.time()
+
+        return df.copy()
+
+    def _lock(self, key) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _dir(self, key) -> str:
+        pair_id, time_bucket = key
+        return os.path.join(self.root, str(pair_id), time_bucket)
+
+    def _read(self, key) -> pd.DataFrame:
+        directory = self._dir(key)
+
+        base = os.path.join(directory, 'base.parquet')
+        deltas = sorted(glob.glob(os.path.join(directory, 'delta-*.parquet')))
+        files = ([base] if os.path.exists(base) else []) + deltas
+        self._deltas[key] = len(deltas)
+
+        if not files:
+            return pd.DataFrame()
+
+        df = pd.concat([pq.read_table(f).to_pandas() for f in files],
+                       ignore_index=True)
+
+        return self._dedupe(df)
+
+    @staticmethod
+    def _merge(df, delta) -> pd.DataFrame:
+        if df.empty:
+            return CandleStore._dedupe(delta)
+
+        return CandleStore._dedupe(pd.concat([df, delta], ignore_index=True))
+
+    @staticmethod
+    def _unchanged(df, delta) -> bool:
+        # the fetched rows are the stored tail as it is
+        if df.empty:
+            return False
+
+        tail = df[df['ts'] >= delta['ts'].min()]
+        delta = delta.sort_values('ts')
+        if len(tail) != len(delta):
+            return False
+
+        return all(column in tail and np.array_equal(tail[column].to_numpy(), delta[column].to_numpy())
+                   for column in delta.columns)
+
+    @staticmethod
+    def _dedupe(df) -> pd.DataFrame:
+        # later rows win, an updated bar replaces the in-progress one
+        df = df.drop_duplicates(subset='ts', keep='last')
+        return df.sort_values('ts', ignore_index=True)
+
+    def _write_delta(self, key, delta):
+        directory = self._dir(key)
+        os.makedirs(directory, exist_ok=True)
+
+        # named by the first ts, a delta that only re-fetches the last bar replaces the previous one
+        fname = os.path.join(directory, f"delta-{int(delta['ts'].iloc[0]):012d}.parquet")
+        created = not os.path.exists(fname)
+        pq.write_table(pa.Table.from_pandas(delta, preserve_index=False), fname)
+
+        # compaction is due after compact_after files, not after compact_after writes
+        if created:
+            self._deltas[key] = self._deltas.get(key, 0) + 1
+
+    def _compact(self, key, df):
+        directory = self._dir(key)
+        logger.info(f"Compacting {key}")
+
+        tmp = os.path.join(directory, 'base.parquet.tmp')
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp)
+        os.replace(tmp, os.path.join(directory, 'base.parquet'))
+
+        for fname in glob.glob(os.path.join(directory, 'delta-*.parquet')):
+            os.remove(fname)
+
+        self._deltas[key] = 0
@@ -1,25 +1,45 @@
-from collections import defaultdict
 import io
-import requests
-import jsonlines
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.json as pa_json
 import pyarrow.parquet as pq
 from decouple import config
 
 from print_color import print
 
+from http_client import make_session
+from instrument import stage
+
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
-API_URL = "https://tradingstrategy.ai/api"
+API_URL = config("TS_API_URL", default="https://tradingstrategy.ai/api")
 API_KEY = config("TS_API_KEY") 
 
 UNISWAP_V2_EXCHANGE_ID = 1
 ETHEREUM_MAINNET_CHAIN_ID = 1
 
-session = requests.Session()
-session.headers.update({'Authorization': API_KEY})
+# known columns of the candles-jsonl endpoint, any other field is inferred
+CANDLE_SCHEMA = pa.schema([
+    ('p', pa.int64()),
+    ('ts', pa.int64()),
+    ('o', pa.float64()),
+    ('h', pa.float64()),
+    ('l', pa.float64()),
+    ('c', pa.float64()),
+    ('v', pa.float64()),
+    ('bv', pa.float64()),
+    ('sv', pa.float64()),
+    ('tc', pa.int64()),
+    ('b', pa.int64()),
+    ('s', pa.int64()),
+])
+
+CANDLE_BLOCK_SIZE = 4 << 20
+CANDLE_BATCH_SIZE = config("CANDLE_BATCH_SIZE", default=100, cast=int)
+
+session = make_session({'Authorization': API_KEY})
 
 def get_json_response(api_path, params=None):
     """
@@ -37,6 +57,7 @@ def get_exchange_universe():
     """
     return get_json_response("exchange-universe")
 
+@stage('get_pair_universe')
 def get_pair_universe(fname=None):
     """
     Get the pair_universe dataframe.
@@ -69,6 +90,27 @@ def get_uniswap_pair_id(pair_universe, pair_address):
 
     return pair_entry['pair_id'].values[0]
 
+def decode_candles(stream, block_size=CANDLE_BLOCK_SIZE) -> pd.DataFrame:
+    """
+    Decode a candles-jsonl stream into a dataframe.
+    The stream is parsed block by block straight into typed arrow columns.
+    @param stream: file-like : the jsonl byte stream
+    @param block_size: int : the number of bytes parsed per block
+    """
+    stream = io.BufferedReader(stream, buffer_size=block_size)
+    if not stream.peek(1):
+        return CANDLE_SCHEMA.empty_table().to_pandas()
+
+    table = pa_json.read_json(
+        stream,
+        read_options=pa_json.ReadOptions(block_size=block_size),
+        parse_options=pa_json.ParseOptions(explicit_schema=CANDLE_SCHEMA,
+                                           unexpected_field_behavior='infer')
+    )
+
+    return table.to_pandas()
+
+@stage('get_candles')
 def get_candles(pair_id,
                 time_bucket,
                 start_time=None,
@@ -82,10 +124,43 @@ def get_candles(pair_id,
     @param end_time: unix_epoch : the end time of the candles
     @param fname: str : the filename to save the candles to
     """
-    url = f"{API_URL}/candles-jsonl"
+    df = _fetch_candles([pair_id], time_bucket, start_time, end_time)
+
+    if fname and not df.empty:
+        df.to_csv(fname)
+
+    return df
+
+def get_candles_batch(pair_ids,
+                      time_bucket,
+                      start_time=None,
+                      end_time=None,
+                      batch_size=CANDLE_BATCH_SIZE) -> dict:
+    """
+    Get candles for many pairs, batch_size pairs per request.
+    @param pair_ids: list : the pair_ids to get candles for
+    @param time_bucket: str : the interval of the candles (1m, 5m, 15m, 1h, etc.)
+    @param start_time: unix_epoch : the start time of the candles
+    @param end_time: unix_epoch : the end time of the candles
+    @param batch_size: int : the number of pairs per request
+    @return: dict : pair_id -> candles dataframe, pairs without candles are left out
+    """
+    pair_ids = list(pair_ids)
+    candles = {}
+
+    for i in range(0, len(pair_ids), batch_size):
+        df = _fetch_candles(pair_ids[i:i + batch_size], time_bucket, start_time, end_time)
+        if df.empty:
+            continue
 
+        for pair_id, pair_df in df.groupby('p', sort=False):
+            candles[int(pair_id)] = pair_df.reset_index(drop=True)
+
+    return candles
+
+def _candle_params(pair_ids, time_bucket, start_time=None, end_time=None) -> dict:
     params = {
-        "pair_ids": str(pair_id),
+        "pair_ids": ",".join(str(pair_id) for pair_id in pair_ids),
         "time_bucket": time_bucket
     }
 
@@ -94,26 +169,25 @@ def get_candles(pair_id,
     if end_time:
         params['end_time'] = end_time
 
+    return params
+
+def _fetch_candles(pair_ids, time_bucket, start_time=None, end_time=None) -> pd.DataFrame:
+    url = f"{API_URL}/candles-jsonl"
+    params = _candle_params(pair_ids, time_bucket, start_time, end_time)
+
     resp = session.get( url,
                         params=params,
                         stream=True)
 
+    resp.raw.decode_content = True
+    # keep the stream readable after EOF, the decoder still holds buffered bytes
+    resp.raw.auto_close = False
+    with resp:
+        df = decode_candles(resp.raw)
+    if df.empty:
+        return df
 
-    reader = jsonlines.Reader(resp.raw)
-    print(resp.raw)
-
-    candle_data = defaultdict(list)
-
-    for idx, item in enumerate(reader):
-        for key, value in item.items():
-            candle_data[key].append(value)
-
-    df = pd.DataFrame.from_dict(candle_data)
-    
     # add a column with ts in utc timezone
     df['ts_utc'] = pd.to_datetime(df['ts'], unit='s')
 
-    if fname:
-        df.to_csv(fname)
-
     return df
@@ -0,0 +1,91 @@
+import logging
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from decouple import config
+
+from instrument import DOWNLOADED_BYTES
+
+logger = logging.getLogger(__name__)
+
+HTTP_TIMEOUT = config("HTTP_TIMEOUT", default=30, cast=float)
+HTTP_CONNECT_TIMEOUT = config("HTTP_CONNECT_TIMEOUT", default=5, cast=float)
+HTTP_RETRIES = config("HTTP_RETRIES", default=3, cast=int)
+HTTP_POOL_SIZE = config("HTTP_POOL_SIZE", default=16, cast=int)
+
+# responses that are worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TimeoutSession(requests.Session):
+    """
+    requests.Session with a default timeout for every request.
+    Response bytes are counted in DOWNLOADED_BYTES per host.
+    """
+
+    def __init__(self, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_TIMEOUT)):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        response = super().request(method, url, **kwargs)
+
+        downloaded = DOWNLOADED_BYTES.labels(urlsplit(response.url).hostname)
+        if kwargs.get('stream'):
+            _count_reads(response.raw, downloaded)
+        else:
+            downloaded.inc(len(response.content))
+
+        return response
+
+
+def _count_reads(raw, counter):
+    # a streamed body is counted as it is read, whether through iter_content or raw
+    read = raw.read
+
+    def counted(*args, **kwargs):
+        data = read(*args, **kwargs)
+        counter.inc(len(data))
+        return data
+
+    raw.read = counted
+
+
+def make_session(headers=None,
+                 retries=HTTP_RETRIES,
+                 pool_size=HTTP_POOL_SIZE) -> requests.Session:
+    """
+    Pooled blocking session with timeouts and jittered retries of idempotent requests.
+    @param headers: dict : headers sent with every request
+    @param retries: int : retries on connection errors and RETRY_STATUSES
+    @param pool_size: int : connections kept open per host
+    """
+    retry = dict(total=retries,
+                 backoff_factor=0.5,
+                 status_forcelist=RETRY_STATUSES,
+                 respect_retry_after_header=True,
+                 raise_on_status=False)
+    try:
+        retry = Retry(**retry, backoff_jitter=0.5)
+    except TypeError:
+        # urllib3 < 2 has no jitter
+        retry = Retry(**retry)
+
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retry)
+
+    session = TimeoutSession()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if headers:
+        session.headers.update(headers)
+
+    return session
+
+
+# shared blocking session for calls without their own headers
+session = make_session()
@@ -0,0 +1,378 @@
+"""
+Counters, callback gauges and latency histograms, served in the Prometheus
+text format on a local /metrics endpoint.
+
+    from instrument import stage
+
+    @stage('predict')
+    def predict(...): ...
+
+    with stage('telegram_upload'):
+        ...
+
+Observations are plain in-memory counts behind a lock per series, a timed
+call costs two perf_counter reads and a bisect. Worker processes start from
+zero after the fork and hand their observations back with their results,
+see drain and merge.
+"""
+import os
+import time
+import bisect
+import inspect
+import logging
+import resource
+import threading
+import functools
+from abc import ABC, abstractmethod
+
+from decouple import config
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = config("METRICS_HOST", default="127.0.0.1")
+# 0 to not serve the metrics
+METRICS_PORT = config("METRICS_PORT", default=9108, cast=int)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from a cached lookup to a full Prophet fit
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = []
+
+
+class _Collector(ABC):
+    """
+    Anything served on /metrics, registered when created.
+    """
+    kind = None
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        """
+        @param name: str : the metric name
+        @param help: str : one line description
+        @param labelnames: tuple : the label names of the samples
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    @abstractmethod
+    def samples(self):
+        """
+        @return: iterable : (name, label string, value) per sample
+        """
+
+    def drain(self) -> dict:
+        return {}
+
+    def merge(self, drained: dict):
+        pass
+
+    def _reset(self):
+        pass
+
+    def _label_str(self, values, extra=()) -> str:
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                   for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class _Metric(_Collector):
+    """
+    A metric holding its own values, one child per label values.
+    """
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        """
+        @param labelnames: tuple : the label names, values are given to labels()
+        """
+        super().__init__(name, help, labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    @abstractmethod
+    def _child(self):
+        """
+        A new child holding the values of one label values tuple.
+        """
+
+    def _reset(self):
+        # in place, decorated functions keep a reference to their child
+        self._lock = threading.Lock()
+        for child in self._children.values():
+            child.reset()
+
+
+class _CounterChild:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self.lock:
+            self.value += amount
+
+    def reset(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1.0):
+        self.labels().inc(amount)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield self.name, self._label_str(values), child.value
+
+    def drain(self) -> dict:
+        drained = {}
+        for values, child in list(self._children.items()):
+            with child.lock:
+                drained[values], child.value = child.value, 0.0
+        return drained
+
+    def merge(self, drained: dict):
+        for values, value in drained.items():
+            self.labels(*values).inc(value)
+
+
+class _Timer:
+    __slots__ = ('child', 'start')
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+    def __call__(self, fn):
+        child = self.child
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def timed_async(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    child.observe(time.perf_counter() - start)
+            return timed_async
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - start)
+        return timed
+
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum', 'lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self) -> _Timer:
+        """
+        Time a block (with) or every call of a function (decorator).
+        """
+        return _Timer(self)
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=STAGE_BUCKETS):
+        """
+        @param buckets: tuple : the upper bounds of the buckets, +Inf is added
+        """
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            with child.lock:
+                counts, total = list(child.counts), child.sum
+
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield f"{self.name}_bucket", self._label_str(values, [('le', le)]), cumulative
+            yield f"{self.name}_sum", self._label_str(values), total
+            yield f"{self.name}_count", self._label_str(values), cumulative
+
+    def drain(self) -> dict:
+        drained = {}
+        for values, child in list(self._children.items()):
+            with child.lock:
+                if any(child.counts):
+                    drained[values] = (child.counts, child.sum)
+                    child.counts, child.sum = [0] * (len(self.buckets) + 1), 0.0
+        return drained
+
+    def merge(self, drained: dict):
+        for values, (counts, total) in drained.items():
+            child = self.labels(*values)
+            with child.lock:
+                child.counts = [a + b for a, b in zip(child.counts, counts)]
+                child.sum += total
+
+
+class Callback(_Collector):
+    """
+    A value read when the metrics are scraped, e.g. a queue length or a cache's hit counts.
+    """
+
+    def __init__(self, name: str, help: str, fn, labelnames=(), kind='gauge'):
+        """
+        @param fn: callable : returns the value, or a dict of label values tuple -> value with labelnames
+        @param kind: str : 'gauge' or 'counter'
+        """
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+        self.kind = kind
+
+    def samples(self):
+        value = self.fn()
+        if not isinstance(value, dict):
+            value = {(): value}
+        for values, sample in value.items():
+            yield self.name, self._label_str(values), sample
+
+
+STAGE_SECONDS = Histogram('stage_seconds', 'Time spent per pipeline stage', ['stage'])
+RPC_SECONDS = Histogram('rpc_seconds', 'JSON-RPC request time per method', ['method'])
+DOWNLOADED_BYTES = Counter('http_downloaded_bytes_total', 'HTTP response bytes received per host', ['host'])
+
+
+def stage(name: str) -> _Timer:
+    """
+    Time a pipeline stage, as a context manager or a decorator.
+    @param name: str : the stage label
+    """
+    return STAGE_SECONDS.labels(name).time()
+
+
+def rss_bytes() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes() -> float:
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+Callback('process_resident_memory_bytes', 'Resident memory of the bot process', rss_bytes)
+Callback('process_peak_resident_memory_bytes', 'Peak resident memory of the bot process', peak_rss_bytes)
+
+
+def exposition() -> str:
+    """
+    All metrics in the Prometheus text format.
+    """
+    lines = []
+    for metric in list(_registry):
+        try:
+            samples = [f"{name}{labels} {float(value)!r}" for name, labels, value in metric.samples()]
+        except Exception as e:
+            # one broken callback must not take the other metrics down with it
+            logger.error(f"Collecting {metric.name} failed: {e!r}")
+            continue
+
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+def drain() -> dict:
+    """
+    Take the observations of this process, to be merged into the parent's.
+    """
+    return {metric.name: metric.drain() for metric in _registry}
+
+
+def merge(drained: dict):
+    metrics = {metric.name: metric for metric in _registry}
+    for name, values in drained.items():
+        metric = metrics.get(name)
+        if metric is not None:
+            metric.merge(values)
+
+
+def _reset_after_fork():
+    # a lock held by another thread at fork time would never be released in the child
+    for metric in _registry:
+        metric._reset()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+async def serve(host=METRICS_HOST, port=METRICS_PORT):
+    """
+    Serve /metrics on the running event loop.
+    @return: aiohttp.web.AppRunner : cleanup() it to stop serving
+    """
+    from aiohttp import web
+
+    async def metrics(request):
+        return web.Response(body=exposition().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get('/metrics', metrics)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,48 @@
+import importlib
+import threading
+
+_UNSET = object()
+
+
+class Lazy:
+    """
+    Proxy for a value that is built on first use.
+
+    The factory runs once, on the first attribute access or get(), and
+    concurrent first uses from several threads wait for the same call.
+    If the factory raises, the next use tries again.
+    """
+
+    def __init__(self, factory):
+        """
+        @param factory: callable : builds the value, called without arguments
+        """
+        self._factory = factory
+        self._value = _UNSET
+        self._lock = threading.RLock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._value is not _UNSET
+
+    def get(self):
+        if self._value is _UNSET:
+            with self._lock:
+                if self._value is _UNSET:
+                    self._value = self._factory()
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __repr__(self):
+        state = repr(self._value) if self.loaded else 'not loaded'
+        return f"<Lazy {state}>"
+
+
+def lazy_import(name: str) -> Lazy:
+    """
+    Import a module on first attribute access.
+    @param name: str : the module name, e.g. 'bc_tools.erc20'
+    """
+    return Lazy(lambda: importlib.import_module(name))
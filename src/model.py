@@ -1,13 +1,45 @@
-from prophet import Prophet
+import logging
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from statistics import NormalDist
+from decouple import config
 
+from cache import LRUCache
+from instrument import stage
+
+FORECAST_ENGINE = config("FORECAST_ENGINE", default="prophet")
+
+# same default as Prophet's interval_width
+INTERVAL_WIDTH = 0.8
+
+# the lightweight engines only look at the trailing part of the history
+WINDOW = 2000
+
+# prophet-fast: trailing rows fitted, uncertainty samples (0 for bands from
+# the fitted noise) and number of series whose last fit is kept for warm starts
+PROPHET_WINDOW = config("PROPHET_WINDOW", default=1000, cast=int)
+PROPHET_UNCERTAINTY_SAMPLES = config("PROPHET_UNCERTAINTY_SAMPLES", default=0, cast=int)
+PROPHET_WARM_STARTS = config("PROPHET_WARM_STARTS", default=256, cast=int)
+
+# below this many rows Prophet uses fewer changepoints, so an old fit does not fit
+WARM_START_MIN_ROWS = 40
+
+# (key, daily) -> parameters of the last prophet-fast fit in this process,
+# the bot keeps them in its own process, see get_warm_starts
+_warm_starts = LRUCache(maxsize=PROPHET_WARM_STARTS)
+
+logger = logging.getLogger(__name__)
+
+@stage('predict')
 def predict(df,
             period: int,
             freq,
             ts_column: str,
-            y_column: str):
+            y_column: str,
+            engine: str = None,
+            key=None):
     """
     Predicts the future values of the given dataframe
 
@@ -16,37 +48,308 @@ def predict(df,
     @param freq: frequency of the prediction
     @param ts_column: name of the column with the timestamp
     @param y_column: name of the column with the values to predict
+    @param engine: name of the forecasting engine, see ENGINES (defaults to FORECAST_ENGINE)
+    @param key: identifies the series, e.g. (pair_id, time_bucket), engines in
+                WARM_START_ENGINES start from the previous fit of the same key
+    @return: dataframe with the ds, yhat, yhat_lower and yhat_upper columns
     """
+    engine = engine or FORECAST_ENGINE
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine {engine}, expected one of {', '.join(ENGINES)}")
 
-    df_prophet = df.rename(columns={ts_column: 'ds', y_column: 'y'})
+    df_known = df[[ts_column, y_column]].rename(columns={ts_column: 'ds', y_column: 'y'})
 
-    model = Prophet()
-    model.fit(df_prophet)
+    if engine in WARM_START_ENGINES:
+        predicted_data = ENGINES[engine](df_known, period, freq, key)
+    else:
+        predicted_data = ENGINES[engine](df_known, period, freq)
+
+    # make prediction and training data continuous by
+    # setting the ds of the first predicted value to the last known value close
+    predicted_data.iloc[0, predicted_data.columns.get_loc('yhat')] = df[y_column].iloc[-1]
+
+    return predicted_data
+
+def prophet(df_known, period: int, freq) -> pd.DataFrame:
+    """
+    Facebook Prophet with default settings.
+    """
+    # imported here, the Prophet / Stan stack is slow to import
+    from prophet import Prophet
+
+    model = Prophet(interval_width=INTERVAL_WIDTH)
+    model.fit(df_known)
 
     future = model.make_future_dataframe(periods=period, freq=freq)
 
     forecast = model.predict(future)
-    predicted_data = forecast.tail(period)
+    return forecast.tail(period).reset_index(drop=True)
 
-    #predicted_data['ds'] = predicted_data['ds'].dt.tz_localize(pytz.utc)#.astype(str)
+def prophet_fast(df_known, period: int, freq, key=None) -> pd.DataFrame:
+    """
+    Prophet tuned for short intraday horizons.
+    Fits the trailing PROPHET_WINDOW rows with only the daily seasonality,
+    starts the optimizer from the previous fit of the same key and predicts
+    the future rows only. Without uncertainty samples the bands come from
+    the fitted observation noise instead of simulated trend changes.
+    """
+    from prophet import Prophet
 
-    # make prediction and training data continuous by 
-    # setting the ds of the first predicted value to the last known value close
-    predicted_data['yhat'].iloc[0] = df[y_column].iloc[-1]
+    df_known = df_known.tail(PROPHET_WINDOW)
+
+    # what 'auto' would pick, fixed so a warm start matches the model
+    span = df_known['ds'].iloc[-1] - df_known['ds'].iloc[0]
+    daily = span >= pd.Timedelta(days=2)
+
+    model = Prophet(interval_width=INTERVAL_WIDTH,
+                    yearly_seasonality=False,
+                    weekly_seasonality=False,
+                    daily_seasonality=daily,
+                    uncertainty_samples=PROPHET_UNCERTAINTY_SAMPLES)
+
+    warm_key = (key, daily)
+    init = _warm_starts.get(warm_key) if key is not None and len(df_known) >= WARM_START_MIN_ROWS else None
+    if init is not None:
+        model.fit(df_known, init=init)
+    else:
+        model.fit(df_known)
+
+    if key is not None:
+        _warm_starts.put(warm_key, _fit_params(model))
+
+    future = model.make_future_dataframe(periods=period, freq=freq, include_history=False)
+    forecast = model.predict(future)
+
+    if 'yhat_lower' not in forecast:
+        z = NormalDist().inv_cdf(0.5 + INTERVAL_WIDTH / 2)
+        sigma = float(model.params['sigma_obs'][0][0]) * model.y_scale
+        forecast['yhat_lower'] = forecast['yhat'] - z * sigma
+        forecast['yhat_upper'] = forecast['yhat'] + z * sigma
+
+    return forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].reset_index(drop=True)
+
+def get_warm_starts(key) -> dict:
+    """
+    The warm starts kept for a series, to hand them to another process.
+    @param key: the series key given to predict
+    @return: dict : daily seasonality -> fitted parameters, empty if there are none
+    """
+    warm = {}
+    for daily in (False, True):
+        if (key, daily) in _warm_starts:
+            warm[daily] = _warm_starts.get((key, daily))
+    return warm
+
+def put_warm_starts(key, warm: dict):
+    """
+    Start the next fit of a series from warm starts taken with get_warm_starts.
+    """
+    for daily, params in warm.items():
+        _warm_starts.put((key, daily), params)
+
+def _fit_params(model) -> dict:
+    """
+    The fitted parameters of a Prophet model in the form fit(init=...) takes.
+    """
+    params = {name: float(model.params[name][0][0]) for name in ('k', 'm', 'sigma_obs')}
+    params.update({name: model.params[name][0] for name in ('delta', 'beta')})
+    return params
+
+def holt(df_known, period: int, freq) -> pd.DataFrame:
+    """
+    Holt's linear exponential smoothing on log prices.
+    The smoothing parameters are picked from a grid that is evaluated for all
+    candidates at once, the bands come from the one-step error variance.
+    """
+    y = _log(df_known['y'].values[-WINDOW:])
+
+    alpha, beta = np.meshgrid([0.1, 0.3, 0.5, 0.7, 0.9],
+                              [0.01, 0.05, 0.1, 0.2, 0.4])
+    alpha, beta = alpha.ravel(), beta.ravel()
+
+    level = np.full(alpha.shape, y[0])
+    trend = np.full(alpha.shape, y[1] - y[0] if len(y) > 1 else 0.0)
+    sse = np.zeros(alpha.shape)
 
+    for value in y[1:]:
+        err = value - (level + trend)
+        sse += err ** 2
+        level = level + trend + alpha * err
+        trend = trend + alpha * beta * err
+
+    best = np.argmin(sse)
+    a, b = alpha[best], beta[best]
+    sigma = np.sqrt(sse[best] / max(len(y) - 1, 1))
+
+    h = np.arange(1, period + 1)
+    yhat = level[best] + h * trend[best]
+
+    # var(h) = sigma^2 * (1 + sum_{j=1}^{h-1} (a * (1 + j * b))^2)
+    c = (a * (1 + np.arange(1, period) * b)) ** 2
+    var = sigma ** 2 * (1 + np.concatenate(([0.0], np.cumsum(c))))
+
+    return _frame(df_known, period, freq, yhat, np.sqrt(var))
+
+def ar(df_known, period: int, freq, order: int = 4) -> pd.DataFrame:
+    """
+    Autoregressive model of the log returns, fitted with least squares.
+    """
+    y = _log(df_known['y'].values[-WINDOW:])
+    r = np.diff(y)
+
+    if len(r) <= 2 * order:
+        return random_walk(df_known, period, freq)
+
+    lags = np.lib.stride_tricks.sliding_window_view(r[:-1], order)[:, ::-1]
+    X = np.column_stack([np.ones(len(lags)), lags])
+    target = r[order:]
+
+    coef, *_ = np.linalg.lstsq(X, target, rcond=None)
+    sigma = np.std(target - X @ coef)
+
+    history = list(r[-order:][::-1])
+    returns = np.empty(period)
+    for i in range(period):
+        returns[i] = coef[0] + np.dot(coef[1:], history[:order])
+        history.insert(0, returns[i])
+
+    # psi weights of the AR process give the variance of the summed returns
+    psi = np.zeros(period)
+    psi[0] = 1.0
+    for j in range(1, period):
+        k = min(j, order)
+        psi[j] = np.dot(coef[1:k + 1], psi[j - k:j][::-1])
+    var = sigma ** 2 * np.cumsum(np.cumsum(psi) ** 2)
+
+    yhat = y[-1] + np.cumsum(returns)
+    return _frame(df_known, period, freq, yhat, np.sqrt(var))
+
+def random_walk(df_known, period: int, freq) -> pd.DataFrame:
+    """
+    Random walk with drift on the log returns.
+    The bands are empirical quantiles of the historical h-step returns.
+    """
+    y = _log(df_known['y'].values[-WINDOW:])
+    r = np.diff(y)
+    drift = r.mean() if len(r) else 0.0
+
+    h = np.arange(1, period + 1)
+    yhat = y[-1] + drift * h
+
+    tail = (1 - INTERVAL_WIDTH) / 2
+    cumulative = np.concatenate(([0.0], np.cumsum(r - drift)))
+
+    lower = np.empty(period)
+    upper = np.empty(period)
+    for i, steps in enumerate(h):
+        moves = cumulative[steps:] - cumulative[:-steps]
+        if len(moves) < 10:
+            # not enough history for this horizon, scale the one-step quantiles
+            moves = (r - drift) * np.sqrt(steps) if len(r) else np.zeros(1)
+        lower[i], upper[i] = np.quantile(moves, [tail, 1 - tail])
+
+    predicted_data = _frame(df_known, period, freq, yhat, 0.0)
+    predicted_data['yhat_lower'] = np.exp(yhat + lower)
+    predicted_data['yhat_upper'] = np.exp(yhat + upper)
     return predicted_data
 
+ENGINES = {
+    'prophet': prophet,
+    'prophet-fast': prophet_fast,
+    'holt': holt,
+    'ar': ar,
+    'rw': random_walk,
+}
+
+# engines slow enough to be worth a process per series
+PROCESS_ENGINES = {'prophet', 'prophet-fast'}
+
+# engines that take the series key to warm start from their last fit
+WARM_START_ENGINES = {'prophet-fast'}
+
+def predict_many(frames: dict,
+                 period: int,
+                 freq,
+                 ts_column: str,
+                 y_column: str,
+                 engine: str = None,
+                 executor=None) -> dict:
+    """
+    Predicts many series at once.
+    Slow engines are fitted in parallel in a process pool, the lightweight
+    engines run in this process where a fit takes a few milliseconds.
+
+    @param frames: dict : key -> dataframe with the known data
+    @param period: number of periods to predict
+    @param freq: frequency of the prediction
+    @param ts_column: name of the column with the timestamp
+    @param y_column: name of the column with the values to predict
+    @param engine: name of the forecasting engine, see ENGINES
+    @param executor: concurrent.futures executor to reuse, a process pool is created if None
+    @return: dict : key -> predicted dataframe, series that failed are left out
+    """
+    engine = engine or FORECAST_ENGINE
+    frames = {key: df for key, df in frames.items() if len(df) > 1}
+    predictions = {}
+
+    if engine not in PROCESS_ENGINES:
+        for key, df in frames.items():
+            try:
+                predictions[key] = predict(df, period, freq, ts_column, y_column, engine, key)
+            except Exception as e:
+                logger.error(f"Prediction for {key} failed: {e}")
+        return predictions
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor()
+
+    try:
+        futures = {
+            key: executor.submit(predict, df, period, freq, ts_column, y_column, engine, key)
+            for key, df in frames.items()
+        }
+        for key, future in futures.items():
+            try:
+                predictions[key] = future.result()
+            except Exception as e:
+                logger.error(f"Prediction for {key} failed: {e}")
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    return predictions
+
+def _log(values) -> np.ndarray:
+    return np.log(np.clip(np.asarray(values, dtype=np.float64), 1e-300, None))
+
+def _frame(df_known, period: int, freq, log_yhat, log_sigma) -> pd.DataFrame:
+    """
+    Build the ds/yhat/yhat_lower/yhat_upper frame from a forecast in log space.
+    """
+    ds = pd.date_range(start=df_known['ds'].iloc[-1], periods=period + 1, freq=freq)[1:]
+    z = NormalDist().inv_cdf(0.5 + INTERVAL_WIDTH / 2)
+
+    return pd.DataFrame({
+        'ds': ds,
+        'yhat': np.exp(log_yhat),
+        'yhat_lower': np.exp(log_yhat - z * log_sigma),
+        'yhat_upper': np.exp(log_yhat + z * log_sigma),
+    })
+
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+
     df = pd.read_csv("data.csv")
     #print(df.info())
 
-    predicted_data = predict(df, 60, timedelta(minutes=5))
+    predicted_data = predict(df, 60, timedelta(minutes=5), 'timestamp', 'close')
 
-    # make prediction and training data continuous by 
+    # make prediction and training data continuous by
     # settings the ds of the first predicted value to the last known value close
     # predicted_data['yhat'].iloc[0] = df['close'].iloc[-1]
 
-    print("\nKNOWN")   
+    print("\nKNOWN")
     print(df.iloc[-1])
     print("\nPREDICTED")
     print(predicted_data.iloc[0:1])
@@ -0,0 +1,109 @@
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter
+
+from decouple import config, Csv
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_HOT_PAIRS = config("PREFETCH_HOT_PAIRS", default=20, cast=int)
+PREFETCH_DELAY = config("PREFETCH_DELAY", default=30, cast=int)
+PREFETCH_SPREAD = config("PREFETCH_SPREAD", default=120, cast=int)
+WATCHLIST = config("WATCHLIST", default="", cast=Csv())
+
+
+class Prefetcher:
+    """
+    Keeps the most requested pairs and a watchlist warm.
+
+    After every bucket boundary (plus a delay for the API to index the new
+    bar) the targets are refreshed one after the other, spread evenly over
+    a time window so the API is not hit by a burst. Request counts halve
+    every bucket, so pairs that stop trending drop out.
+    """
+
+    def __init__(self,
+                 refresh,
+                 bucket_seconds=900,
+                 delay=PREFETCH_DELAY,
+                 spread=PREFETCH_SPREAD,
+                 hot=PREFETCH_HOT_PAIRS,
+                 watchlist=()):
+        """
+        @param refresh: async callable : refresh(pair_id) fetches and precomputes one pair
+        @param bucket_seconds: int : the candle interval in seconds
+        @param delay: int : seconds to wait after a bucket boundary
+        @param spread: int : seconds the refreshes are spread over
+        @param hot: int : number of most requested pairs to keep warm
+        @param watchlist: list or callable : pair_ids that are always kept warm,
+                          a callable is resolved on the first refresh
+        """
+        self.refresh = refresh
+        self.bucket_seconds = bucket_seconds
+        self.delay = delay
+        self.spread = spread
+        self.hot = hot
+        self.watchlist = watchlist
+
+        self.requests = Counter()
+        self._lock = threading.Lock()
+        self._task = None
+
+    def record(self, pair_id):
+        """
+        Count a request for pair_id, safe to call from any thread.
+        """
+        with self._lock:
+            self.requests[int(pair_id)] += 1
+
+    def targets(self) -> list:
+        with self._lock:
+            hot = [pair_id for pair_id, _ in self.requests.most_common(self.hot)]
+
+        if callable(self.watchlist):
+            self.watchlist = list(self.watchlist())
+
+        return list(dict.fromkeys(list(self.watchlist) + hot))
+
+    def start(self) -> asyncio.Task:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run(), name="prefetcher")
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def run(self):
+        while True:
+            now = time.time()
+            next_boundary = now - now % self.bucket_seconds + self.bucket_seconds
+            await asyncio.sleep(next_boundary + self.delay - now)
+
+            await self.refresh_all()
+            self._decay()
+
+    async def refresh_all(self):
+        targets = self.targets()
+        if not targets:
+            return
+
+        logger.info(f"Prefetching {len(targets)} pairs")
+        interval = self.spread / len(targets)
+
+        for pair_id in targets:
+            started = time.monotonic()
+            try:
+                await self.refresh(pair_id)
+            except Exception as e:
+                logger.error(f"Prefetching {pair_id} failed: {e}")
+
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    def _decay(self):
+        with self._lock:
+            self.requests = Counter({pair_id: count // 2
+                                     for pair_id, count in self.requests.items()
+                                     if count > 1})
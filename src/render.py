@@ -1,25 +1,124 @@
-import model
-import candles
 import logging
+import threading
 
-import matplotlib.pyplot as plt
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.dates as mdates
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import io
 
 import pandas as pd
+from decouple import config
+
+from instrument import stage
 
 logging.basicConfig(level=logging.INFO)
 
+# output of the charts sent to telegram, sizes in pixels
+CHART_FORMAT = config("CHART_FORMAT", default="jpg")
+CHART_DPI = config("CHART_DPI", default=100, cast=int)
+CHART_WIDTH = config("CHART_WIDTH", default=640, cast=int)
+CHART_HEIGHT = config("CHART_HEIGHT", default=480, cast=int)
+# Pillow's default, what the charts were saved with before it was a setting
+CHART_QUALITY = config("CHART_QUALITY", default=75, cast=int)
+
+# formats that take a quality setting
+LOSSY_FORMATS = ('jpg', 'jpeg', 'webp')
+
+class ChartTemplate:
+    """
+    A figure with the known, predicted and bound lines already set up.
+    Rendering only swaps the line data, so one template can be reused for
+    every chart drawn by a thread.
+    """
+
+    def __init__(self, width=CHART_WIDTH, height=CHART_HEIGHT, dpi=CHART_DPI):
+        """
+        @param width: int : image width in pixels
+        @param height: int : image height in pixels
+        @param dpi: int : dots per inch, scales the text and lines
+        """
+        self.figure = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot()
+
+        self.known, = self.ax.plot([], [], color='black', label='Known Data')
+        self.yhat, = self.ax.plot([], [], color='blue', label='Predicted Values')
+        self.upper, = self.ax.plot([], [], color='green', linestyle='dashed', label='Upper Bound')
+        self.lower, = self.ax.plot([], [], color='red', linestyle='dashed', label='Lower Bound')
+
+        self.ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+        self.ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+
+        self.ax.set_xlabel('Time')
+        self.ax.set_ylabel('Closed Price')
+        #self.ax.set_title('Prognosis')
+
+    def draw(self, df, predicted_data):
+        ds = mdates.date2num(predicted_data['ds'])
+
+        self.known.set_data(mdates.date2num(df['ts_utc']), df['c'])
+        self.yhat.set_data(ds, predicted_data['yhat'])
+        self.upper.set_data(ds, predicted_data['yhat_upper'])
+        self.lower.set_data(ds, predicted_data['yhat_lower'])
+
+        self.ax.relim()
+        self.ax.autoscale_view()
+
+        for label in self.ax.get_xticklabels():
+            label.set_rotation(45)
+            label.set_horizontalalignment('right')
+
+    def save(self, fname=None, format=CHART_FORMAT, quality=CHART_QUALITY) -> io.BytesIO:
+        if fname:
+            self.figure.savefig(fname)
+
+        pil_kwargs = {'quality': quality} if format in LOSSY_FORMATS else None
+
+        buffer = io.BytesIO()
+        self.figure.savefig(buffer, format=format, pil_kwargs=pil_kwargs)
+        buffer.seek(0)
+        return buffer
+
+    def close(self):
+        self.figure.clear()
+        self.figure = self.ax = None
+
+_templates = threading.local()
+
+def _template(width, height, dpi) -> ChartTemplate:
+    templates = getattr(_templates, 'templates', None)
+    if templates is None:
+        templates = _templates.templates = {}
+
+    template = templates.get((width, height, dpi))
+    if template is None:
+        template = templates[width, height, dpi] = ChartTemplate(width, height, dpi)
+    return template
+
+@stage('render')
 def render(_df,
            _predicted_data,
            cutoff_delta: str,
-           fname=None) -> io.BytesIO:
+           fname=None,
+           reuse=True,
+           format=CHART_FORMAT,
+           width=CHART_WIDTH,
+           height=CHART_HEIGHT,
+           dpi=CHART_DPI) -> io.BytesIO:
     """
     Render a graph with known data and predicted data.
+    Each thread reuses its own figure, nothing touches the global pyplot state.
     @param _df: pd.DataFrame : the known data
     @param _predicted_data: pd.DataFrame : the predicted data
     @param cutoff_delta: str : the cutoff delta to use
     @param fname: str : the filename to save the graph to
+    @param reuse: bool : reuse this thread's figure, False draws on a new figure that is released afterwards
+    @param format: str : the image format, e.g. jpg, png or webp
+    @param width: int : image width in pixels
+    @param height: int : image height in pixels
+    @param dpi: int : dots per inch
     """
 
     # copies
@@ -27,39 +126,31 @@ def render(_df,
     predicted_data = _predicted_data
 
     # cutoff
-    if type(df['ts_utc'].iloc[-1]) == str:
-        df['ts_utc'] = pd.to_datetime(df['ts_utc'])
-
-    cutoff_time = df.iloc[-1]['ts_utc'] - pd.to_timedelta(cutoff_delta)
-
-    df = df[df['ts_utc'] > cutoff_time]
-
-    # plot with plt (known data)
-    plt.plot(df['ts_utc'], df['c'], color='black', label='Known Data')
+    ts_utc = df['ts_utc']
+    if type(ts_utc.iloc[-1]) == str:
+        ts_utc = pd.to_datetime(ts_utc)
 
-    # plot with plt (prediction)
-    plt.plot(predicted_data['ds'], predicted_data['yhat'], color='blue', label='Predicted Values')
+    cutoff_time = ts_utc.iloc[-1] - pd.to_timedelta(cutoff_delta)
 
-    plt.plot(predicted_data['ds'], predicted_data['yhat_upper'], color='green', linestyle='dashed', label='Upper Bound')
-    plt.plot(predicted_data['ds'], predicted_data['yhat_lower'], color='red', linestyle='dashed', label='Lower Bound')
+    df = pd.DataFrame({'ts_utc': ts_utc, 'c': df['c']})[ts_utc > cutoff_time]
 
-    plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%H:%M')) 
-    plt.xticks(rotation=45, ha='right')
+    if reuse:
+        template = _template(width, height, dpi)
+        template.draw(df, predicted_data)
+        return template.save(fname, format)
 
-    plt.xlabel('Time')
-    plt.ylabel('Closed Price')
-    #plt.title('Prognosis')
-
-    if fname:
-        plt.savefig(fname)
-
-    buffer = io.BytesIO()
-    plt.savefig(buffer, format='jpg')
-    buffer.seek(0)
-    return buffer
+    template = ChartTemplate(width, height, dpi)
+    try:
+        template.draw(df, predicted_data)
+        return template.save(fname, format)
+    finally:
+        template.close()
 
 
 def main(pair_address: str):
+    import model
+    import candles
+
     # open candles.csv as dataframe
     df = pd.read_csv("candles.csv")
     predicted_data = model.predict(df, 20, "15min", "ts_utc", "c")
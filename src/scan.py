@@ -0,0 +1,54 @@
+import argparse
+
+from candles import get_candles_batch
+from model import predict_many
+
+
+def forecast_pairs(pair_ids,
+                   time_bucket="15m",
+                   period=30,
+                   freq="15min",
+                   engine=None,
+                   executor=None) -> dict:
+    """
+    Fetch and forecast many pairs at once.
+    @param pair_ids: list : the pair_ids to forecast
+    @param time_bucket: str : the interval of the candles
+    @param period: int : number of periods to predict
+    @param freq: str : frequency of the prediction, matching time_bucket
+    @param engine: str : the forecasting engine, see model.ENGINES
+    @param executor: concurrent.futures executor for the slow engines
+    @return: dict : pair_id -> (candles, predicted_data)
+    """
+    frames = get_candles_batch(pair_ids, time_bucket)
+    predictions = predict_many(frames, period, freq, "ts_utc", "c", engine, executor)
+
+    return {pair_id: (frames[pair_id], predicted_data)
+            for pair_id, predicted_data in predictions.items()}
+
+
+def rank(forecasts: dict) -> list:
+    """
+    Rank pairs by the predicted change over the forecast horizon.
+    @param forecasts: dict : the result of forecast_pairs
+    @return: list : (pair_id, change in %) sorted from best to worst
+    """
+    changes = []
+    for pair_id, (df, predicted_data) in forecasts.items():
+        last = df['c'].iloc[-1]
+        change = (predicted_data['yhat'].iloc[-1] - last) / last * 100
+        changes.append((pair_id, change))
+
+    return sorted(changes, key=lambda item: item[1], reverse=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Forecast and rank a list of pairs")
+    parser.add_argument('pair_ids', type=int, nargs='+')
+    parser.add_argument('--engine', default=None)
+    parser.add_argument('--period', type=int, default=30)
+    args = parser.parse_args()
+
+    forecasts = forecast_pairs(args.pair_ids, period=args.period, engine=args.engine)
+    for pair_id, change in rank(forecasts):
+        print(f"{pair_id}: {change:+.2f}%")
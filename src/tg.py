@@ -2,28 +2,99 @@ import asyncio
 import logging
 import colorlog
 
-from datetime import datetime, timedelta
+from functools import partial
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters.command import Command
 from aiogram.filters import CommandObject
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.types import FSInputFile, URLInputFile, BufferedInputFile
 
 
 import io
+import os
+import hashlib
 from decouple import config
 
 
-from model import predict
-from candles import get_candles, get_uniswap_pair_id, get_pair_universe
-from render import render
-from bc_tools import erc20, common
+from worker import AnalysisPool, PoolBusy, SingleFlight
+from prefetch import Prefetcher, WATCHLIST
+from cache import LRUCache
+from lazy import Lazy, lazy_import
+from alerts import AlertEngine, Notifier, METRICS, WATCH_PERCENT, format_value
+import instrument
+from instrument import stage
 
-import pandas as pd
 from decimal import Decimal
 from print_color import print
 
-w3 = common.connect_web3()
+# pandas, pyarrow, web3 and friends are imported on first use,
+# so the bot starts polling without paying for them
+candles = lazy_import('candles')
+model = lazy_import('model')
+analytics = lazy_import('analytics')
+erc20 = lazy_import('bc_tools.erc20')
+common = lazy_import('bc_tools.common')
+price = lazy_import('bc_tools.price')
+
+def connect_web3():
+    web3 = common.make_web3()
+    common.eth_usd_oracle.add_source(partial(price.onchain_eth_usd, web3))
+    common.eth_usd_oracle.start()
+    return web3
+
+def open_pair_universe():
+    from universe import PairUniverse
+    return PairUniverse().start()
+
+def open_candle_store():
+    from candle_store import CandleStore, CANDLE_STORE_PATH
+    if CANDLE_SOURCE == 'onchain':
+        from bc_tools.candle_builder import OnchainCandles
+        fetch = OnchainCandles(w3.get(),
+                               pair_universe.get_pair_address,
+                               quote_usd=common.eth_usd_oracle.get)
+        # kept apart from the API candles, the two are not mixed in one file
+        store = CandleStore(root=os.path.join(CANDLE_STORE_PATH, 'onchain'), fetch=fetch)
+    else:
+        store = CandleStore()
+    store.listeners.append(metrics.on_candles)
+    # after metrics, the volume alerts read its snapshot
+    store.listeners.append(on_candles_alerts)
+    return store
+
+def open_live_tip():
+    from bc_tools.live import LiveTip
+    tip = LiveTip(w3.get(), quote_usd=common.eth_usd_oracle.get, keep=alert_engine.has_pair)
+    tip.listeners.append(on_live_bar)
+    return tip.start()
+
+# started in main(), before anything else starts threads
+pool = AnalysisPool()
+# concurrent /ca and /pair requests for the same address share one analysis
+analyses = SingleFlight()
+w3 = Lazy(connect_web3)
+pair_universe = Lazy(open_pair_universe)
+candle_store = Lazy(open_candle_store)
+metrics = Lazy(lambda: analytics.MetricsRegistry())
+live_tip = Lazy(open_live_tip)
+# loaded in main()
+alert_engine = AlertEngine()
+# 'api' for the TradingStrategy candles, 'onchain' to build them from the pair's logs
+CANDLE_SOURCE = config("CANDLE_SOURCE", default="api")
+# merge an in-progress bar read from the pair's reserves into the candles
+LIVE_TIP = config("LIVE_TIP", default=True, cast=bool)
+# seconds between candle refreshes of the pairs with volume alerts
+ALERT_REFRESH = config("ALERT_REFRESH", default=900, cast=int)
+# candles fetched this recently (e.g. by the prefetcher) are served without an API call
+CANDLE_MAX_AGE = config("CANDLE_MAX_AGE", default=60, cast=int)
+forecast_cache = LRUCache(maxsize=config("FORECAST_CACHE_SIZE", default=256, cast=int),
+                          ttl=config("FORECAST_CACHE_TTL", default=900, cast=int),
+                          path=config("FORECAST_CACHE_PATH", default=None))
+# telegram file_id of every chart already uploaded, by the digest of the image
+chart_file_ids = LRUCache(maxsize=config("CHART_FILE_ID_CACHE_SIZE", default=4096, cast=int))
+# the same setting render encodes the charts with, read here without importing matplotlib
+CHART_FORMAT = config("CHART_FORMAT", default="jpg")
 
 import json
 
@@ -58,89 +129,236 @@ def setup_logger():
 # Initialize the logger
 logger = setup_logger()
 
-def analyse_ca(ca):
-    token = erc20.ERC20(w3, ca)
-    now = datetime.now()
+def forecast(pair_id, df, engine=None, time_bucket="15m", period=30, freq="15min", cutoff_delta="72 hours",
+             live=None):
+    """
+    Predict and render, reusing the result while the last candle is unchanged.
+    The forecast is fitted on the candles alone. A live bar is applied after the
+    lookup: the cached forecast is anchored to its close and the chart is rendered again.
+    @param df: pd.DataFrame : the candles, without the live bar
+    @param live: dict : the in-progress bar, see LiveTip.bar
+    """
+    engine = engine or model.FORECAST_ENGINE
+    key = (int(pair_id), time_bucket, period, cutoff_delta, engine, int(df['ts'].iloc[-1]))
+
+    cached = forecast_cache.get(key)
+    if cached is None:
+        cached = pool.forecast(df, period, freq, cutoff_delta, engine, (int(pair_id), time_bucket))
+        forecast_cache.put(key, cached)
+    else:
+        logger.debug(f"Forecast cache hit {key}, {forecast_cache.stats()}")
+
+    # the image bytes are immutable and shared, only the frame is copied
+    predicted_data, img = cached
+    predicted_data = predicted_data.copy()
+
+    if live is not None:
+        from bc_tools.live import merge_bar
+        merged = merge_bar(df, live)
+        if merged is not df:
+            # the same anchor model.predict sets, on the live close
+            predicted_data.iloc[0, predicted_data.columns.get_loc('yhat')] = live['c']
+            img = pool.render(merged, predicted_data, cutoff_delta)
+
+    return predicted_data, img
+
+def warm_pair(pair_id):
+    """
+    Fetch the new candles of a pair and precompute its default forecast and image.
+    """
+    # the live bar is applied per request, the cached forecast is fitted on the candles
+    forecast(pair_id, candle_store.get_candles(pair_id, "15m"))
 
-    # get candles
-    pair_universe = get_pair_universe()
-    pair_id = get_uniswap_pair_id(pair_universe, str(token.pair_address).lower())
-    df = get_candles(pair_id, "15m")
-    
-    # predict
-    predicted_data = predict(df, 30, "15min", "ts_utc", "c")
+async def prefetch_pair(pair_id):
+    await pool.run(warm_pair, pair_id)
 
-    # render
-    img = render(df, predicted_data, "72 hours")
+def watchlist_pair_ids():
+    pair_ids = []
+    for pair_address in WATCHLIST:
+        try:
+            pair_ids.append(pair_universe.get_pair_id(pair_address))
+        except ValueError as e:
+            logger.error(f"Watchlist: {e}")
+    return pair_ids
 
-    # define time periods for trend analysis
-    times = [1, 12, 24, 168]  # hours for 1h, 12h, 24h and 1 week (168h)
-    trends = {}
+prefetcher = Prefetcher(prefetch_pair, watchlist=watchlist_pair_ids)
 
-    # token supply without decimals
-    total_supply = token.get_total_supply('Ether')
+def live_candles(pair_id, pair_address, df):
+    """
+    The candles with the in-progress bar of the pair, and that bar.
+    Falls back to the candles alone if the reserves can not be read.
+    """
+    if not LIVE_TIP:
+        return df, None
 
-    for time in times:
-        try:
-            logger.info(f'Calcing {time}h trend...', time)
-            past_time = now - timedelta(hours=time)
-            last_time_period = df[df['ts_utc'] > past_time]
+    from bc_tools.live import merge_bar
+    try:
+        live_tip.track(pair_id, pair_address)
+    except Exception as e:
+        logger.warning(f"Live tip unavailable for {pair_address}: {e}")
+        return df, None
 
-            initial_price = last_time_period.iloc[0]['p']
-            final_price = last_time_period.iloc[-1]['p']
-            percentage_change = ((final_price - initial_price) / initial_price) * 100
+    bar = live_tip.bar(pair_id)
+    return merge_bar(df, bar), bar
 
-            trends[f'{time}h_trend'] = percentage_change
-        except Exception as e:
-            logger.error(f"Exception: {e}")
+def trading_stats(pair_id, df, live=None, time_bucket="15m"):
+    """
+    Trends and 24h stats up to the last candle, or up to the live bar if given.
+    """
+    stats = metrics.snapshot((int(pair_id), time_bucket), live)
+    if stats is None:
+        stats = analytics.compute(df, now=int(df['ts'].iloc[-1]))
+        if live is not None:
+            stats['current_price'] = float(df['c'].iloc[-1])
+    return stats
+
+async def send_notification(chat_id, text):
+    try:
+        await bot.send_message(chat_id, text)
+    except TelegramForbiddenError:
+        removed = alert_engine.remove_chat(chat_id)
+        logger.info(f"Chat {chat_id} blocked the bot, removed its {removed} alerts")
+
+notifier = Notifier(send_notification)
+
+def cache_stats(field):
+    caches = {'forecast': forecast_cache, 'chart_file_id': chart_file_ids}
+    return lambda: {(name,): cache.stats()[field] for name, cache in caches.items()}
+
+# read on every scrape of /metrics
+instrument.Callback('analyses_accepted', 'Analyses holding a pool slot, running or waiting', lambda: pool.pending)
+instrument.Callback('analyses_in_flight', 'Distinct analyses running, joined requests share one', lambda: len(analyses))
+instrument.Callback('pool_calls', 'Blocking calls waiting for or holding an analysis thread',
+                    lambda: {('queued',): pool.queued, ('running',): pool.running}, ['state'])
+instrument.Callback('notifications_queued', 'Alert messages waiting to be sent',
+                    lambda: sum(len(texts) for texts in list(notifier.pending.values())))
+instrument.Callback('cache_hits_total', 'Cache hits', cache_stats('hits'), ['cache'], kind='counter')
+instrument.Callback('cache_misses_total', 'Cache misses', cache_stats('misses'), ['cache'], kind='counter')
+instrument.Callback('cache_hit_ratio', 'Cache hits over lookups', cache_stats('hit_ratio'), ['cache'])
+
+def notify(messages):
+    for chat_id, text in messages:
+        notifier.push(chat_id, text)
+
+def on_live_bar(pair_id, bar):
+    """
+    LiveTip listener, evaluates the price alerts of the pair at every block.
+    """
+    if bar is not None:
+        notify(alert_engine.update(pair_id, 'price', bar['c']))
+
+def on_candles_alerts(key, df, delta):
+    """
+    CandleStore listener, evaluates the 24h volume alerts of the pair, and
+    its price alerts too if the live tip does not follow it.
+    """
+    pair_id, time_bucket = key
+    if time_bucket != "15m" or df.empty or not alert_engine.has_pair(pair_id):
+        return
 
+    stats = metrics.snapshot(key)
+    if stats is not None:
+        notify(alert_engine.update(pair_id, 'volume', stats['volume']))
 
-    # get 24h stats
-    last_24_hours = df[df['ts_utc'] > (now - timedelta(hours=24))]
+    if not (live_tip.loaded and live_tip.bar(pair_id) is not None):
+        notify(alert_engine.update(pair_id, 'price', float(df['c'].iloc[-1])))
 
-    volume_24h = last_24_hours['v'].sum()
-    buy_volume_24h = last_24_hours['bv'].sum()
-    sell_volume_24h = last_24_hours['sv'].sum()
-    transactions_24h = last_24_hours['tc'].sum()
-    buy_transactions_24h = last_24_hours['b'].sum()
-    sell_transactions_24h = last_24_hours['s'].sum()
+def pair_snapshot(address):
+    """
+    Resolve a pair or token address, start following the pair's price and
+    read its current price and 24h volume.
+    @return: dict : pair_id, pair_address, label, price and volume
+    """
+    try:
+        pair_id = pair_universe.get_pair_id(address)
+        pair_address, label = address, f"{address[:6]}…{address[-4:]}"
+    except ValueError:
+        token = erc20.ERC20(w3.get(), address)
+        pair_address, label = token.pair_address, token.symbol
+        pair_id = pair_universe.get_pair_id(pair_address)
+
+    df = candle_store.get_candles(pair_id, "15m", max_age=CANDLE_MAX_AGE)
+    df, live = live_candles(pair_id, pair_address, df)
+    stats = trading_stats(pair_id, df, live)
+
+    return {
+        'pair_id': pair_id,
+        'pair_address': pair_address,
+        'label': label,
+        'price': stats['current_price'],
+        'volume': stats['volume'],
+    }
 
-    peak_price_24h = last_24_hours['h'].max()
-    peak_mcap_24h = Decimal(peak_price_24h) * total_supply
+def follow_alert_pairs():
+    """
+    Follow the price of every pair with alerts again after a restart.
+    """
+    for pair_id, pair_address in alert_engine.pairs().items():
+        try:
+            live_tip.track(pair_id, pair_address)
+        except Exception as e:
+            logger.error(f"Following alert pair {pair_address} failed: {e}")
 
-    low_price_24h = last_24_hours['h'].min()
-    low_mcap_24h = Decimal(low_price_24h) * total_supply
+async def refresh_alert_pairs():
+    """
+    Refresh the candles of the pairs with volume alerts, which evaluates them.
+    Without the live tip the price alerts are evaluated the same way.
+    """
+    while True:
+        await asyncio.sleep(ALERT_REFRESH)
+        for pair_id in alert_engine.pairs('volume' if LIVE_TIP else None):
+            try:
+                await pool.run(candle_store.get_candles, pair_id, "15m", CANDLE_MAX_AGE)
+            except Exception as e:
+                logger.error(f"Refreshing alert pair {pair_id} failed: {e}")
 
-    current_price = df.iloc[-1]['h']
-    mcap = current_price * total_supply
+def analyse_ca(ca, engine=None):
+    token = erc20.ERC20(w3.get(), ca)
 
-    peak_price_all = df['h'].max()
-    peak_mcap_all = Decimal(peak_price_all) * token.get_total_supply('Ether')
-    peak_price_time = df[df['h'] == peak_price_all].iloc[0]['ts_utc']
+    # get candles
+    pair_id = pair_universe.get_pair_id(token.pair_address)
+    prefetcher.record(pair_id)
+    candles_df = candle_store.get_candles(pair_id, "15m", max_age=CANDLE_MAX_AGE)
+    df, live = live_candles(pair_id, token.pair_address, candles_df)
+    
+    # predict and render
+    predicted_data, img = forecast(pair_id, candles_df, engine, live=live)
+
+    # token supply without decimals
+    total_supply = token.get_total_supply('Ether')
 
-    reserves = token.get_reserves()
+    # trends and 24h stats, kept up to date as candles arrive
+    stats = trading_stats(pair_id, df, live)
+
+    peak_mcap_24h = Decimal(stats['peak_price']) * total_supply
+    low_mcap_24h = Decimal(stats['low_price']) * total_supply
+    mcap = Decimal(stats['current_price']) * total_supply
+    peak_mcap_all = Decimal(stats['peak_price_all']) * total_supply
+
+    # read together with the token data in ERC20's multicall
+    reserves = token.reserves or token.get_reserves()
     liquidity = common.eth_usd(reserves['weth'], 'Wei')
 
     # package results into json
     results = {
-        "trends": trends,
+        "trends": stats['trends'],
         "24h_stats": {
-            "volume": volume_24h,
-            "buy_volume": buy_volume_24h,
-            "sell_volume": sell_volume_24h,
-            "transactions": transactions_24h,
-            "buy_transactions": buy_transactions_24h,
-            "sell_transactions": sell_transactions_24h,
-            "peak_price": peak_price_24h,
+            "volume": stats['volume'],
+            "buy_volume": stats['buy_volume'],
+            "sell_volume": stats['sell_volume'],
+            "transactions": stats['transactions'],
+            "buy_transactions": stats['buy_transactions'],
+            "sell_transactions": stats['sell_transactions'],
+            "peak_price": stats['peak_price'],
             "peak_mcap": peak_mcap_24h,
-            "low_price": low_price_24h,
+            "low_price": stats['low_price'],
             "low_mcap": low_mcap_24h,
         },
-        "current_price": current_price,
+        "current_price": stats['current_price'],
         "mcap": mcap,
-        "peak_price_all": peak_price_all,
+        "peak_price_all": stats['peak_price_all'],
         "peak_mcap_all": peak_mcap_all,
-        "peak_price_time": peak_price_time,
+        "peak_price_time": stats['peak_price_time'],
         "liquidity": liquidity,
     }
 
@@ -182,48 +400,34 @@ def format_analytics(data):
 
     return analytics
 
-def analyse_pair(pair_address):
+def analyse_pair(pair_address, engine=None):
     result = {}
-    pair_universe = get_pair_universe()
-    pair_id = get_uniswap_pair_id(pair_universe,
-                                  pair_address)
+    pair_id = pair_universe.get_pair_id(pair_address)
 
-    df = get_candles(pair_id, "15m")
+    prefetcher.record(pair_id)
+    candles_df = candle_store.get_candles(pair_id, "15m", max_age=CANDLE_MAX_AGE)
     logging.info("Got candles")
+    df, live = live_candles(pair_id, pair_address, candles_df)
 
     # add a column with ts in utc timezone
     #df['ts_utc'] = pd.to_datetime(df['ts'], unit='s')
 
-    predicted_data = predict(df, 30, "15min", "ts_utc", "c")
-
-    # render
-    img = render(df, predicted_data, "72 hours")
+    # predict and render
+    predicted_data, img = forecast(pair_id, candles_df, engine, live=live)
     result['img'] = img
 
-    last_24_hours = df[df['ts'] > (df.iloc[-1]['ts'] - 86400)]
-
-    volume_24h = last_24_hours['v'].sum()
-    buy_volume_24h = last_24_hours['bv'].sum()
-    sell_volume_24h = last_24_hours['sv'].sum()
-
-    transactions_24h = last_24_hours['tc'].sum()
-    buy_transactions_24h = last_24_hours['b'].sum()
-    sell_transactions_24h = last_24_hours['s'].sum()
-
-    peak_price = df['h'].max()
-    peak_price_time = df[df['h'] == peak_price].iloc[0]['ts_utc']
-
-    analytics = f"""
-    📊 Volume (24h): ${volume_24h/1000}K
-    📈 Buy Volume (24h): ${buy_volume_24h/1000}K
-    📉 Sell Volume (24h): ${sell_volume_24h/1000}K
-    🔄 Transactions (24h): {transactions_24h:.0f}
-    📈 Buy Transactions (24h): {buy_transactions_24h:.0f}
-    📉 Sell Transactions (24h): {sell_transactions_24h:.0f}
-    🔝 Peak Price: {peak_price:.2e} $ at {peak_price_time}
+    # 24h stats up to the live bar
+    stats = trading_stats(pair_id, df, live)
+
+    result['analytics'] = f"""
+    📊 Volume (24h): ${stats['volume']/1000}K
+    📈 Buy Volume (24h): ${stats['buy_volume']/1000}K
+    📉 Sell Volume (24h): ${stats['sell_volume']/1000}K
+    🔄 Transactions (24h): {stats['transactions']:.0f}
+    📈 Buy Transactions (24h): {stats['buy_transactions']:.0f}
+    📉 Sell Transactions (24h): {stats['sell_transactions']:.0f}
+    🔝 Peak Price: {stats['peak_price_all']:.2e} $ at {stats['peak_price_time']}
     """
-
-    result['analytics'] = analytics
     return result
 
 logging.basicConfig(level=logging.INFO)
@@ -234,42 +438,227 @@ dp = Dispatcher()
 async def cmd_start(message: types.Message):
     await message.answer("Hello!")
 
+def user_id(message: types.Message):
+    return message.from_user.id if message.from_user else message.chat.id
+
+async def run_analysis(message: types.Message, fn, address: str, engine: str = None):
+    """
+    Run fn(address, engine) on the pool, joining an identical analysis
+    that is already running instead of starting a new one.
+    @return: the analysis, None if the user was told the pool is busy or the analysis failed
+    """
+    key = (fn.__name__, address.lower(), "15m", engine or model.FORECAST_ENGINE)
+
+    # no await from the lookup until the analysis is registered, an identical
+    # request arriving in between would start a second one
+    if key in analyses:
+        # joining costs no pool capacity
+        analysis = analyses.start(key, pool.run, fn, address, engine)
+    else:
+        try:
+            slot = pool.slot(user_id(message))
+        except PoolBusy as e:
+            await message.answer(str(e))
+            return None
+        analysis = analyses.start(key, pool.run, fn, address, engine)
+        # held while the analysis runs, whatever happens to this request
+        analysis.add_done_callback(lambda _: slot.release())
+
+    try:
+        ack = await message.answer("⏳ Working…")
+        try:
+            # shield: this request being cancelled must not cancel the shared analysis
+            return await asyncio.shield(analysis)
+        finally:
+            await ack.delete()
+    except Exception as e:
+        logger.warning(f"Analysing {address} failed: {e!r}")
+        await message.answer(f"❌ Could not analyse {address}, please try again later.")
+    return None
+
+async def answer_chart(message: types.Message, image: bytes, caption: str):
+    """
+    Answer with a chart, resending it by file_id if the same image was uploaded before.
+    @param image: bytes : the encoded chart, passed to the upload without copying
+    """
+    key = hashlib.sha1(image).digest()
+
+    file_id = chart_file_ids.get(key)
+    if file_id is not None:
+        try:
+            with stage('telegram_resend'):
+                return await message.answer_photo(file_id, caption=caption)
+        except TelegramBadRequest as e:
+            logger.warning(f"Cached file_id was rejected, uploading again: {e}")
+
+    with stage('telegram_upload'):
+        sent = await message.answer_photo(
+            BufferedInputFile(image, filename=f"graph.{CHART_FORMAT}"),
+            caption=caption
+        )
+    if sent.photo:
+        chart_file_ids.put(key, sent.photo[-1].file_id)
+    return sent
+
+def parse_args(args: str):
+    """
+    Split '<address> [engine]' command arguments.
+    """
+    address, _, engine = args.strip().partition(' ')
+    engine = engine.strip() or None
+
+    if engine is not None and engine not in model.ENGINES:
+        raise ValueError(f"Unknown engine {engine}, use one of: {', '.join(model.ENGINES)}")
+
+    return address, engine
+
 @dp.message(Command('pair'))
 async def cmd_pair(message: types.Message, command: CommandObject):
     if command.args:
-        pair_address = command.args
-        analysis = analyse_pair(pair_address)
-        graph_bytes = analysis['img']
-        caption = analysis['analytics']
-
-        await message.answer_photo(
-            BufferedInputFile(
-                graph_bytes.read(),
-                filename="graph.jpg"
-            ),
-            caption=caption
-        )
+        try:
+            pair_address, engine = parse_args(command.args)
+        except ValueError as e:
+            await message.answer(str(e))
+            return
+
+        analysis = await run_analysis(message, analyse_pair, pair_address, engine)
+        if analysis is None:
+            return
+
+        await answer_chart(message, analysis['img'], analysis['analytics'])
 
 @dp.message(Command('ca'))
 async def cmd_ca(message: types.Message, command: CommandObject):
     if command.args:
-        ca = str(command.args)
-        analysis = analyse_ca(ca)
+        try:
+            ca, engine = parse_args(str(command.args))
+        except ValueError as e:
+            await message.answer(str(e))
+            return
 
-        graph_bytes = analysis['image']
-        caption = format_analytics(analysis['analytics'])
+        analysis = await run_analysis(message, analyse_ca, ca, engine)
+        if analysis is None:
+            return
 
-        await message.answer_photo(
-            BufferedInputFile(
-                graph_bytes.read(),
-                filename="graph.jpg"
-            ),
-            caption=caption
-        )
+        await answer_chart(message, analysis['image'], format_analytics(analysis['analytics']))
+
+def parse_alert_args(args: str):
+    """
+    Split '<address> <price|volume> <value>' /alert arguments.
+    """
+    parts = args.split()
+    if len(parts) != 3 or parts[1] not in METRICS:
+        raise ValueError(f"Usage: /alert <address> <{'|'.join(METRICS)}> <value in USD>")
+
+    try:
+        value = float(parts[2].lstrip('$').replace(',', ''))
+    except ValueError:
+        raise ValueError(f"{parts[2]} is not a number")
+
+    return parts[0], parts[1], value
+
+async def lookup_pair(message: types.Message, address: str):
+    """
+    Run pair_snapshot on the pool, telling the user if it fails.
+    @return: dict : see pair_snapshot, None if the user was told why not
+    """
+    try:
+        with pool.slot(user_id(message)):
+            return await pool.run(pair_snapshot, address)
+    except PoolBusy as e:
+        await message.answer(str(e))
+    except Exception as e:
+        logger.warning(f"Looking up {address} failed: {e}")
+        await message.answer(f"Could not find a Uniswap v2 pair for {address}")
+    return None
+
+@dp.message(Command('alert'))
+async def cmd_alert(message: types.Message, command: CommandObject):
+    try:
+        address, metric, value = parse_alert_args(command.args or "")
+    except ValueError as e:
+        await message.answer(str(e))
+        return
+
+    pair = await lookup_pair(message, address)
+    if pair is None:
+        return
+
+    try:
+        alert = alert_engine.add_alert(message.chat.id, pair['pair_id'], pair['pair_address'],
+                                       pair['label'], metric, value, pair[metric])
+    except ValueError as e:
+        await message.answer(str(e))
+        return
+
+    await message.answer(f"✅ {alert.describe()}, now {format_value(metric, pair[metric])}")
+
+@dp.message(Command('watch'))
+async def cmd_watch(message: types.Message, command: CommandObject):
+    address, _, percent = (command.args or "").strip().partition(' ')
+    try:
+        if not address:
+            raise ValueError
+        percent = float(percent.strip().rstrip('%')) if percent.strip() else WATCH_PERCENT
+    except ValueError:
+        await message.answer(f"Usage: /watch <address> [move in %, default {WATCH_PERCENT:g}]")
+        return
+
+    pair = await lookup_pair(message, address)
+    if pair is None:
+        return
+
+    try:
+        alert = alert_engine.add_watch(message.chat.id, pair['pair_id'], pair['pair_address'],
+                                       pair['label'], pair['price'], percent)
+    except ValueError as e:
+        await message.answer(str(e))
+        return
+
+    await message.answer(f"👀 {alert.describe()}")
+
+@dp.message(Command('alerts'))
+async def cmd_alerts(message: types.Message):
+    alerts = alert_engine.list(message.chat.id)
+    if not alerts:
+        await message.answer("No alerts, add one with /alert or /watch")
+        return
+
+    await message.answer('\n'.join(alert.describe() for alert in alerts))
+
+@dp.message(Command('unalert'))
+async def cmd_unalert(message: types.Message, command: CommandObject):
+    arg = (command.args or "").strip().lstrip('#')
+
+    if arg == 'all':
+        removed = alert_engine.remove_chat(message.chat.id)
+        await message.answer(f"Removed {removed} alerts")
+    elif arg.isdigit() and alert_engine.remove(int(arg), message.chat.id):
+        await message.answer(f"Removed alert #{arg}")
+    else:
+        await message.answer("Usage: /unalert <id from /alerts | all>")
 
 
 async def main():
-    await dp.start_polling(bot)
+    pool.start()
+    prefetcher.start()
+    metrics_server = await instrument.serve() if instrument.METRICS_PORT else None
+    await pool.run(alert_engine.load)
+    notifier.start()
+    alert_refresher = asyncio.create_task(refresh_alert_pairs(), name="alert-refresh")
+    if LIVE_TIP and len(alert_engine):
+        asyncio.ensure_future(pool.run(follow_alert_pairs))
+    try:
+        await dp.start_polling(bot)
+    finally:
+        prefetcher.stop()
+        notifier.stop()
+        alert_refresher.cancel()
+        if live_tip.loaded:
+            live_tip.stop()
+        pool.shutdown()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
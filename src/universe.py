@@ -0,0 +1,209 @@
+import io
+import os
+import json
+import time
+import threading
+import logging
+
+import pyarrow.parquet as pq
+from decouple import config
+
+from candles import (API_URL,
+                     session,
+                     UNISWAP_V2_EXCHANGE_ID,
+                     ETHEREUM_MAINNET_CHAIN_ID)
+from instrument import stage
+
+logger = logging.getLogger(__name__)
+
+PAIR_UNIVERSE_PATH = config("PAIR_UNIVERSE_PATH", default="data/pair-universe.parquet")
+PAIR_UNIVERSE_TTL = config("PAIR_UNIVERSE_TTL", default=3600, cast=int)
+
+# only these columns are needed to resolve a pair address to a pair_id
+INDEX_COLUMNS = ['pair_id', 'address', 'exchange_id', 'chain_id']
+
+
+class PairUniverse:
+    """
+    Pair universe that is downloaded once, persisted to disk and refreshed
+    in the background. Lookups go through a hash index keyed by
+    (lowercase address, exchange_id, chain_id).
+    """
+
+    def __init__(self,
+                 path=PAIR_UNIVERSE_PATH,
+                 ttl=PAIR_UNIVERSE_TTL,
+                 url=f"{API_URL}/pair-universe"):
+        """
+        @param path: str : where the pair_universe parquet is persisted
+        @param ttl: int : seconds after which the pair_universe is refreshed
+        @param url: str : the url to download from, None to only use the local file
+        """
+        self.path = path
+        self.meta_path = f"{path}.json"
+        self.ttl = ttl
+        self.url = url
+
+        self.table = None
+        self.index = {}
+        self.addresses = {}
+        self.meta = {}
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """
+        Load the pair_universe from disk, downloading it if missing or stale.
+        """
+        if os.path.exists(self.path):
+            self._read_meta()
+            self._set_table(pq.read_table(self.path))
+
+        if self.table is None or self.is_stale():
+            self.refresh()
+
+        return self
+
+    def is_stale(self) -> bool:
+        return time.time() - self.meta.get('fetched_at', 0) > self.ttl
+
+    def refresh(self, force=False) -> bool:
+        """
+        Re-download the pair_universe if it changed upstream.
+        Uses ETag / If-Modified-Since so an unchanged universe costs one 304.
+        Concurrent callers share a single refresh.
+        @param force: bool : ignore the cached validators
+        @return: bool : True if a new universe was loaded
+        """
+        if self.url is None:
+            return False
+
+        if not self._lock.acquire(blocking=False):
+            # another thread is already refreshing, wait for it instead of downloading twice
+            with self._lock:
+                return False
+
+        try:
+            headers = {}
+            if not force and self.table is not None:
+                if self.meta.get('etag'):
+                    headers['If-None-Match'] = self.meta['etag']
+                if self.meta.get('last_modified'):
+                    headers['If-Modified-Since'] = self.meta['last_modified']
+
+            with stage('get_pair_universe'):
+                response = session.get(self.url, headers=headers)
+
+            if response.status_code == 304:
+                logger.info("Pair universe not modified")
+                self.meta['fetched_at'] = time.time()
+                self._write_meta()
+                return False
+
+            response.raise_for_status()
+
+            table = pq.read_table(io.BytesIO(response.content))
+            self._persist(response.content)
+
+            self.meta = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'fetched_at': time.time(),
+            }
+            self._write_meta()
+            self._set_table(table)
+
+            logger.info(f"Pair universe refreshed, {len(self.index)} pairs")
+            return True
+        finally:
+            self._lock.release()
+
+    def start(self):
+        """
+        Load the pair_universe and keep it fresh from a daemon thread.
+        """
+        self.load()
+
+        if self.url is not None and self._thread is None:
+            self._thread = threading.Thread(target=self._refresh_loop,
+                                            name="pair-universe-refresh",
+                                            daemon=True)
+            self._thread.start()
+
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def get_pair_id(self,
+                    pair_address: str,
+                    exchange_id=UNISWAP_V2_EXCHANGE_ID,
+                    chain_id=ETHEREUM_MAINNET_CHAIN_ID) -> int:
+        """
+        Get the pair_id for a given pair_address.
+        @param pair_address: str : the pair contract address
+        @param exchange_id: int : the exchange to look in, defaults to Uniswap v2
+        @param chain_id: int : the chain to look in, defaults to Ethereum mainnet
+        """
+        key = (str(pair_address).lower(), exchange_id, chain_id)
+        try:
+            return self.index[key]
+        except KeyError:
+            raise ValueError(f"Pair {pair_address} not found in pair universe")
+
+    def get_pair_address(self, pair_id: int) -> str:
+        """
+        Get the pair contract address for a given pair_id.
+        @param pair_id: int : the pair_id
+        """
+        try:
+            return self.addresses[int(pair_id)]
+        except KeyError:
+            raise ValueError(f"Pair {pair_id} not found in pair universe")
+
+    def to_pandas(self):
+        return self.table.to_pandas()
+
+    def _set_table(self, table):
+        columns = table.select(INDEX_COLUMNS).to_pydict()
+
+        index = {
+            (str(address).lower(), exchange_id, chain_id): pair_id
+            for pair_id, address, exchange_id, chain_id in zip(*columns.values())
+        }
+        addresses = dict(zip(columns['pair_id'], columns['address']))
+
+        # the indexes are fully built before they are published to readers
+        self.table, self.index, self.addresses = table, index, addresses
+
+    def _persist(self, content: bytes):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, self.path)
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+        except (OSError, ValueError):
+            self.meta = {}
+
+    def _write_meta(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.meta_path, 'w') as f:
+            json.dump(self.meta, f)
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.ttl):
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Pair universe refresh failed: {e}")
@@ -0,0 +1,290 @@
+import os
+import asyncio
+import logging
+import threading
+import multiprocessing
+from multiprocessing import forkserver
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from decouple import config
+
+import instrument
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_THREADS = config("ANALYSIS_THREADS", default=8, cast=int)
+ANALYSIS_PROCESSES = config("ANALYSIS_PROCESSES", default=os.cpu_count() or 1, cast=int)
+ANALYSIS_QUEUE_SIZE = config("ANALYSIS_QUEUE_SIZE", default=32, cast=int)
+ANALYSIS_PER_USER = config("ANALYSIS_PER_USER", default=2, cast=int)
+# same setting as model.PROPHET_WARM_STARTS, model is too slow to import here
+PROPHET_WARM_STARTS = config("PROPHET_WARM_STARTS", default=256, cast=int)
+
+
+class PoolBusy(Exception):
+    """
+    Raised when the analysis queue is full.
+    """
+
+
+class UserBusy(PoolBusy):
+    """
+    Raised when a user already has the maximum number of analyses running.
+    """
+
+
+def forecast(df, period: int, freq, cutoff_delta: str, engine: str = None, key=None, warm=None):
+    """
+    Fit the model and render the graph, runs inside a worker process.
+    @param df: pd.DataFrame : the candles
+    @param period: int : number of periods to predict
+    @param freq: str : frequency of the prediction
+    @param cutoff_delta: str : how much known data to render
+    @param engine: str : the forecasting engine, see model.ENGINES
+    @param key: tuple : identifies the series for warm starts, e.g. (pair_id, time_bucket)
+    @param warm: dict : the warm starts of key from the parent, see model.get_warm_starts
+    @return: tuple : the predicted data, the encoded image as bytes and the warm starts of key after the fit
+    """
+    from model import predict, get_warm_starts, put_warm_starts
+
+    if warm:
+        put_warm_starts(key, warm)
+    predicted_data = predict(df, period, freq, "ts_utc", "c", engine, key)
+    warm = get_warm_starts(key) if key is not None else {}
+    return predicted_data, chart(df, predicted_data, cutoff_delta), warm
+
+
+def chart(df, predicted_data, cutoff_delta: str) -> bytes:
+    """
+    Render the graph of a forecast, runs inside a worker process.
+    @return: bytes : the encoded image
+    """
+    from render import render
+
+    # bytes pickle without the BytesIO wrapper and are sent as they are
+    return render(df, predicted_data, cutoff_delta).getvalue()
+
+
+def _instrumented(fn, *args):
+    # the stage timings of a worker process travel back with its result
+    return fn(*args), instrument.drain()
+
+
+def _warmup():
+    # pay for the model and plotting imports before the first request does
+    import model
+    import render
+    return os.getpid()
+
+
+class AnalysisPool:
+    """
+    Runs analyses off the event loop.
+
+    Blocking I/O (RPC, HTTP, disk) runs in a thread pool, the CPU bound
+    fitting and rendering is handed to a process pool. The number of
+    accepted analyses is bounded in total and per user, callers are
+    rejected with PoolBusy instead of queueing without limit.
+    """
+
+    def __init__(self,
+                 threads=ANALYSIS_THREADS,
+                 processes=ANALYSIS_PROCESSES,
+                 queue_size=ANALYSIS_QUEUE_SIZE,
+                 per_user=ANALYSIS_PER_USER):
+        """
+        @param threads: int : number of analyses running at once
+        @param processes: int : number of processes fitting models
+        @param queue_size: int : number of analyses waiting for a thread
+        @param per_user: int : number of analyses a single user may have accepted
+        """
+        self.max_pending = threads + queue_size
+        self.per_user = per_user
+
+        self.threads = ThreadPoolExecutor(threads, thread_name_prefix="analysis")
+        self.process_count = processes
+        # fork: the bot module is slow to re-import in every new child
+        self.processes = self._process_pool('fork')
+        self._restart_lock = threading.Lock()
+        # key -> the last fit of a series, any worker may fit it next
+        self.warm_starts = LRUCache(maxsize=PROPHET_WARM_STARTS)
+
+        self.pending = 0
+        self.user_pending = Counter()
+        # blocking calls waiting for or holding a thread
+        self.queued = 0
+        self.running = 0
+        self._counts = threading.Lock()
+
+    def start(self):
+        """
+        Start the worker processes up front, before the bot starts its own threads,
+        and the fork server that starts their replacements if one dies.
+        Does not wait for the workers to finish importing.
+        """
+        self._warm()
+
+        # the server is a fresh interpreter that imports the bot once, a
+        # replacement forked from it can not inherit a lock held by a bot thread
+        multiprocessing.get_context('forkserver').set_forkserver_preload(['__main__', 'worker'])
+        forkserver.ensure_running()
+        return self
+
+    def _warm(self):
+        for _ in range(self.process_count):
+            self.processes.submit(_warmup)
+
+    def _process_pool(self, method) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(self.process_count,
+                                   mp_context=multiprocessing.get_context(method))
+
+    def _restart(self, broken):
+        """
+        Replace a process pool that lost a worker (e.g. OOM-killed), every
+        later submit to it would fail until the bot restarts.
+        @param broken: ProcessPoolExecutor : the pool the failed call was submitted to
+        """
+        with self._restart_lock:
+            if self.processes is not broken:
+                # another thread already replaced it
+                return
+            logger.error("A worker process died, restarting the process pool")
+            broken.shutdown(wait=False, cancel_futures=True)
+            # forking the bot now would copy the state of its running threads
+            self.processes = self._process_pool('forkserver')
+            self._warm()
+
+    def slot(self, user_id) -> '_Slot':
+        """
+        Reserve a place for one analysis of user_id, to be used as a context manager.
+        Must be called from the event loop.
+        @param user_id: int : the telegram user requesting the analysis
+        """
+        if self.pending >= self.max_pending:
+            raise PoolBusy("⏳ Too many requests right now, please try again in a minute.")
+        if self.user_pending[user_id] >= self.per_user:
+            raise UserBusy("⏳ Your previous requests are still running, please wait for them.")
+
+        self.pending += 1
+        self.user_pending[user_id] += 1
+        return _Slot(self, user_id)
+
+    def _release(self, user_id):
+        self.pending -= 1
+        self.user_pending[user_id] -= 1
+        if self.user_pending[user_id] <= 0:
+            del self.user_pending[user_id]
+
+    async def run(self, fn, *args):
+        """
+        Run a blocking function in the thread pool.
+        """
+        loop = asyncio.get_running_loop()
+        with self._counts:
+            self.queued += 1
+        return await loop.run_in_executor(self.threads, self._tracked, fn, *args)
+
+    def _tracked(self, fn, *args):
+        with self._counts:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return fn(*args)
+        finally:
+            with self._counts:
+                self.running -= 1
+
+    def forecast(self, df, period: int, freq, cutoff_delta: str, engine: str = None, key=None):
+        """
+        Fit and render in a worker process, blocks the calling thread until done.
+        @return: tuple : the predicted data and the encoded image as bytes
+        """
+        warm = self.warm_starts.get(key) if key is not None else None
+        predicted_data, img, warm = self._submit(forecast, df, period, freq, cutoff_delta, engine, key, warm)
+        if warm:
+            self.warm_starts.put(key, warm)
+        return predicted_data, img
+
+    def render(self, df, predicted_data, cutoff_delta: str) -> bytes:
+        """
+        Render a forecast in a worker process, blocks the calling thread until done.
+        """
+        return self._submit(chart, df, predicted_data, cutoff_delta)
+
+    def _submit(self, fn, *args):
+        # raises BrokenProcessPool if a worker died, the pool is restarted for the next calls
+        processes = self.processes
+        try:
+            result, observed = processes.submit(_instrumented, fn, *args).result()
+        except BrokenProcessPool:
+            self._restart(processes)
+            raise
+        instrument.merge(observed)
+        return result
+
+    def shutdown(self):
+        self.threads.shutdown(wait=False, cancel_futures=True)
+        self.processes.shutdown(wait=False, cancel_futures=True)
+
+
+class _Slot:
+    def __init__(self, pool, user_id):
+        self.pool = pool
+        self.user_id = user_id
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def release(self):
+        self.pool._release(self.user_id)
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one in-progress call.
+
+    The first caller starts the computation, callers that arrive while it
+    runs await the same future and get the same result (or exception).
+    Nothing is cached, the key is free again once the call finishes.
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+        self.shared = 0
+
+    def __contains__(self, key) -> bool:
+        return key in self._in_flight
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    def start(self, key, fn, *args) -> asyncio.Future:
+        """
+        Start the call, or join the one in flight, without awaiting it.
+        Looking up and registering the key is one step on the event loop,
+        an identical call can not slip in between.
+        @param key: hashable : calls with equal keys are coalesced
+        @param fn: async callable : called as fn(*args) by the first caller
+        @return: asyncio.Future : the shared call, await it through asyncio.shield
+        """
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn(*args))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.shared += 1
+            logger.debug(f"Joined in-flight call {key}")
+        return future
+
+    async def run(self, key, fn, *args):
+        """
+        Start or join the call and wait for its result, see start.
+        """
+        # shield: one waiter being cancelled must not cancel the shared call
+        return await asyncio.shield(self.start(key, fn, *args))
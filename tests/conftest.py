@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the modules are flat in src/, as when the bot is run from there
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, os.path.abspath(SRC))
+os.environ.setdefault('TS_API_KEY', 'test')
@@ -0,0 +1,32 @@
+import pytest
+
+import analytics
+from bench import synthetic_candles
+from bc_tools.live import merge_bar
+
+
+def _assert_same(stats, expected):
+    assert stats['trends'] == pytest.approx(expected['trends'])
+    assert stats['peak_price_time'] == expected['peak_price_time']
+    for name, value in expected.items():
+        if name not in ('trends', 'peak_price_time'):
+            # the running sums keep the rounding of the bars that left the window
+            assert stats[name] == pytest.approx(value, abs=1e-6), name
+
+
+# same ts as the last candle, the next bucket, past the 1h and past the 24h window
+@pytest.mark.parametrize('gap', [0, 900, 2 * 3600, 2 * 86400])
+def test_snapshot_with_live_bar(gap):
+    df = synthetic_candles(300, seed=3)
+    last = df.iloc[-1]
+    live = {'ts': int(last['ts']) + gap, 'o': last['c'], 'h': last['c'] * 1.2, 'l': last['c'] * 0.7, 'c': last['c'] * 1.1}
+
+    metrics = analytics.RollingMetrics.from_frame(df)
+    merged = merge_bar(df, live)
+    expected = analytics.compute(merged, now=live['ts'])
+    # with a live bar the current price is its close
+    expected['current_price'] = live['c']
+
+    _assert_same(metrics.snapshot(live), expected)
+    # reading with a live bar leaves the windows as they were
+    _assert_same(metrics.snapshot(), analytics.compute(df, now=int(last['ts'])))
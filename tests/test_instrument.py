@@ -0,0 +1,33 @@
+import pytest
+
+import instrument
+
+
+def test_callback_has_no_children():
+    callback = instrument.Callback('test_callback', 'A test value', lambda: {('a',): 1, ('b',): 2}, ['name'])
+    assert not hasattr(callback, 'labels')
+    assert callback.drain() == {}
+
+    text = instrument.exposition()
+    assert '# TYPE test_callback gauge' in text
+    assert 'test_callback{name="b"} 2.0' in text
+
+
+def test_metric_needs_child():
+    class Childless(instrument._Metric):
+        def samples(self):
+            return []
+
+    with pytest.raises(TypeError):
+        Childless('test_childless', 'No children')
+
+
+def test_counter_drain_and_merge():
+    counter = instrument.Counter('test_counter_total', 'A test counter', ['host'])
+    counter.labels('x').inc(3)
+    drained = instrument.drain()
+    assert drained['test_counter_total'] == {('x',): 3.0}
+    assert counter.labels('x').value == 0.0
+
+    instrument.merge(drained)
+    assert counter.labels('x').value == 3.0
@@ -0,0 +1,43 @@
+import os
+import signal
+
+import pytest
+from concurrent.futures.process import BrokenProcessPool
+
+from bench import synthetic_candles
+from worker import AnalysisPool
+
+
+def _die():
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def test_forecast_after_worker_died():
+    pool = AnalysisPool(threads=1, processes=2).start()
+    try:
+        with pytest.raises(BrokenProcessPool):
+            pool._submit(_die)
+
+        df = synthetic_candles(300, seed=1)
+        predicted_data, img = pool.forecast(df, 10, '15min', '24 hours', 'rw')
+
+        assert len(predicted_data) == 10
+        assert img
+    finally:
+        pool.shutdown()
+
+
+def test_warm_starts_kept_in_parent():
+    pool = AnalysisPool(threads=1, processes=2).start()
+    try:
+        df = synthetic_candles(300, seed=2)
+        pool.forecast(df, 10, '15min', '24 hours', 'prophet-fast', ('test', '15m'))
+        warm = pool.warm_starts.get(('test', '15m'))
+        assert warm and set(next(iter(warm.values()))) >= {'k', 'm', 'delta'}
+
+        # the next fit starts from them in whichever worker picks it up
+        predicted_data, img = pool.forecast(df, 10, '15min', '24 hours', 'prophet-fast', ('test', '15m'))
+        assert len(predicted_data) == 10
+        assert pool.warm_starts.get(('test', '15m')) is not warm
+    finally:
+        pool.shutdown()